@@ -0,0 +1,275 @@
+import os
+
+# benchmark runs without window and sound
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import argparse
+import json
+import random
+import sys
+import tempfile
+from time import perf_counter
+
+import pygame
+from lib import (DISPLAY_RESOLUTION, RAYS_AMOUNT, RENDER_WORKERS, process_projectiles, render_image, process_input, process_movement,
+                 load_level, load_level_chunks, draw_minimap, update_entities, build_solid_grid, Compositor, SpatialHash,
+                 assets, merge_wall_sides, CollisionGrid, ResolutionGovernor, EntityStore, ProjectilePool,
+                 FrustumCuller, load_pvs, compile_level, SimulationClock, FlowField)
+
+
+STAGES = ("input", "movement", "projectiles", "render", "minimap")
+RENDER_MODES = ("scan", "segments", "grid", "batch", "compositor", "parallel")
+COLLISION_MODES = ("closures", "grid")
+ENTITY_MODES = ("objects", "store")
+CULL_MODES = ("none", "frustum", "pvs")
+AI_MODES = ("straight", "flow")
+DT = 1 / 60
+
+'''
+input script is a list of steps (frames, keys, mouse buttons, mouse shift from screen center),
+it is repeated until all frames are done
+'''
+INPUT_SCRIPT = (
+    (60, (pygame.K_w,), (0, 0, 0), 0),
+    (30, (pygame.K_w,), (0, 0, 0), 40),
+    (45, (pygame.K_w, pygame.K_LSHIFT), (1, 0, 0), 0),
+    (30, (pygame.K_a,), (0, 0, 0), -60),
+    (45, (pygame.K_s, pygame.K_d), (1, 0, 0), 20),
+    (30, (), (1, 0, 0), 100),
+)
+
+
+class ScriptedKeys:
+    # behaves like pygame.key.get_pressed() result
+    def __init__(self, keys: tuple):
+        self.keys = set(keys)
+
+    def __getitem__(self, key: int):
+        return key in self.keys
+
+
+def scripted_input(frames: int, script=INPUT_SCRIPT):
+    # yields (pressed_keys, pressed_mouse_buttons, mouse_pos) for every frame
+    center_x, center_y = DISPLAY_RESOLUTION[0] // 2, DISPLAY_RESOLUTION[1] // 2
+    frame = 0
+    while True:
+        for length, keys, buttons, mouse_shift in script:
+            pressed_keys = ScriptedKeys(keys)
+            for _ in range(length):
+                if frame == frames:
+                    return
+                yield pressed_keys, buttons, (center_x + mouse_shift, center_y)
+                frame += 1
+
+
+def generate_level(width: int, height: int, seed: int, enemies_amount: int, wall_density=0.15):
+    # random level with border walls, player spawn in the center and enemies spawns
+    rng = random.Random(seed)
+    rows = []
+    for y in range(height):
+        row = []
+        for x in range(width):
+            if x in (0, width - 1) or y in (0, height - 1) or rng.random() < wall_density:
+                row.append("#")
+            else:
+                row.append("0")
+        rows.append(row)
+
+    center_x, center_y = width // 2, height // 2
+    # free area around player spawn
+    for y in range(center_y - 1, center_y + 2):
+        for x in range(center_x - 1, center_x + 2):
+            rows[y][x] = "0"
+    rows[center_y][center_x] = "@"
+
+    floor = [(x, y) for y in range(height) for x in range(width)
+             if rows[y][x] == "0" and max(abs(x - center_x), abs(y - center_y)) > 3]
+    for x, y in rng.sample(floor, min(enemies_amount, len(floor))):
+        rows[y][x] = "!"
+    return ["".join(row) for row in rows]
+
+
+def percentile(values: list, q: float):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+def summary(values: list):
+    return {
+        "mean": sum(values) / len(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values),
+    }
+
+
+def run_level(screen: pygame.Surface, path: str, render_mode: str, frames: int, rays_amount: int,
+              collision_mode="grid", workers=RENDER_WORKERS, target_fps=None, entity_mode="store",
+              cull_mode="none", chunked=False, ai_mode="flow"):
+    # store mode keeps enemies and projectiles in arrays
+    # chunked level builds walls only near player, walls for scan and segments are taken every frame
+    store = EntityStore() if entity_mode == "store" else None
+    start = perf_counter()
+    if chunked:
+        player, level_objs_map, entities, minimap = load_level_chunks(screen, path, store)
+        walls = level_objs_map.walls_near(player.pos)
+    else:
+        player, level_objs_map, entities, minimap = load_level(screen, path, store)
+        # wall objects are built only for modes that cast walls lists, the other ones cast level map
+        walls = level_objs_map.all_walls() if render_mode in ("scan", "segments") else None
+    solid_grid = build_solid_grid(level_objs_map)
+    load_time = perf_counter() - start
+    compositor = Compositor(workers=workers if render_mode == "parallel" else 1)
+    entity_index = SpatialHash([*entities, player])
+    collision_grid = CollisionGrid(level_objs_map) if collision_mode == "grid" else None
+    projectiles = ProjectilePool() if entity_mode == "store" else []
+    # with flow field chasing enemies go around walls
+    flow_field = FlowField(level_objs_map) if ai_mode == "flow" else None
+
+    render_kwargs = {}
+    if render_mode == "segments":
+        render_kwargs["segments"] = merge_wall_sides(walls)
+    if cull_mode != "none":
+        render_kwargs["culler"] = FrustumCuller(walls, render_kwargs.get("segments"),
+                                                load_pvs(path) if cull_mode == "pvs" else None)
+    if render_mode in ("grid", "batch", "compositor", "parallel"):
+        render_kwargs["level_map"] = level_objs_map
+    if render_mode in ("batch", "compositor", "parallel"):
+        render_kwargs["solid_grid"] = solid_grid
+    if render_mode in ("compositor", "parallel"):
+        render_kwargs["compositor"] = compositor
+
+    # with target fps rays amount is changed by resolution governor
+    governor = ResolutionGovernor(1 / target_fps, rays_amount=rays_amount) if target_fps else None
+    timings = {stage: [] for stage in STAGES}
+    totals = []
+    rays = []
+    # walls, segments, entities and projectiles left for rays by culler
+    candidates = []
+    # simulation time doesn't depend on how long frames take
+    sim_clock = SimulationClock()
+    for pressed_keys, pressed_mouse_buttons, mouse_pos in scripted_input(frames):
+        now = sim_clock.now()
+
+        start = perf_counter()
+        if chunked and render_mode in ("scan", "segments"):
+            walls = level_objs_map.walls_near(player.pos)
+            if render_mode == "segments":
+                render_kwargs["segments"] = merge_wall_sides(walls)
+        process_input(pressed_keys, pressed_mouse_buttons, mouse_pos, DT, player, projectiles, now)
+        after_input = perf_counter()
+        process_movement(entities, player, level_objs_map, projectiles, DT, now, entity_index, collision_grid,
+                         store, flow_field)
+        after_movement = perf_counter()
+        projectiles = process_projectiles(projectiles, entities, player, DT, now, entity_index)
+        entities = update_entities(entities, entity_index, store)
+        after_projectiles = perf_counter()
+        render_image(screen, player, walls, entities, projectiles, rays_amount, now, **render_kwargs)
+        after_render = perf_counter()
+        draw_minimap(screen, minimap, player)
+        end = perf_counter()
+        rays.append(rays_amount)
+        if cull_mode != "none":
+            candidates.append(render_kwargs["culler"].last_counts)
+
+        timings["input"].append(after_input - start)
+        timings["movement"].append(after_movement - after_input)
+        timings["projectiles"].append(after_projectiles - after_movement)
+        timings["render"].append(after_render - after_projectiles)
+        timings["minimap"].append(end - after_render)
+        totals.append(end - start)
+        if governor is not None:
+            rays_amount = governor.update(end - start)
+        sim_clock.advance(DT * 1000)
+
+    return {
+        "level": path,
+        "render_mode": render_mode,
+        "collision_mode": collision_mode,
+        "entity_mode": entity_mode,
+        "cull_mode": cull_mode,
+        "ai_mode": ai_mode,
+        "flow_field_updates": flow_field.updates if flow_field else None,
+        "chunked": chunked,
+        "load_time": load_time,
+        "chunks_built": level_objs_map.built if chunked else None,
+        "rays_amount": summary(rays),
+        "workers": compositor.workers,
+        "frames": len(totals),
+        "walls": len(walls) if walls is not None else int(solid_grid.sum()),
+        "entities_left": len(entities),
+        "player_health": player.health,
+        "frame": summary(totals),
+        "candidates": {name: sum(counts[i] for counts in candidates) / len(candidates)
+                       for i, name in enumerate(("walls", "segments", "entities", "projectiles"))}
+        if candidates else None,
+        "stages": {stage: summary(values) for stage, values in timings.items()},
+        "per_frame": {"frame": totals, "rays": rays, **timings},
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Headless deterministic benchmark, prints JSON results (seconds)")
+    parser.add_argument("--levels", nargs="*", default=["levels/level_3.txt"], help="level files")
+    parser.add_argument("--generated", nargs="*", default=["64x64"], help="sizes of generated levels, WIDTHxHEIGHT")
+    parser.add_argument("--enemies", type=int, default=20, help="enemies amount on generated levels")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--modes", nargs="*", default=list(RENDER_MODES), choices=RENDER_MODES)
+    parser.add_argument("--collision", default="grid", choices=COLLISION_MODES)
+    parser.add_argument("--entity-mode", default="store", choices=ENTITY_MODES)
+    parser.add_argument("--cull", default="none", choices=CULL_MODES,
+                        help="pvs needs levels compiled with compile_levels.py --pvs")
+    parser.add_argument("--ai", default="flow", choices=AI_MODES, help="how chasing enemies find player")
+    parser.add_argument("--chunked", action="store_true", help="stream level chunks near player, without culling")
+    parser.add_argument("--workers", type=int, default=RENDER_WORKERS, help="threads for parallel render mode")
+    parser.add_argument("--target-fps", type=float, help="change rays amount to hold this frame rate")
+    parser.add_argument("--frames", type=int, default=240)
+    parser.add_argument("--rays", type=int, default=RAYS_AMOUNT)
+    parser.add_argument("--per-frame", action="store_true", help="keep per frame timings in output")
+    parser.add_argument("--output", help="file for results, stdout by default")
+    args = parser.parse_args(argv)
+
+    pygame.init()
+    screen = pygame.display.set_mode(DISPLAY_RESOLUTION)
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        levels = list(args.levels)
+        for size in args.generated:
+            width, height = (int(i) for i in size.split("x"))
+            path = os.path.join(tmp_dir, f"generated_{size}_{args.seed}.txt")
+            with open(path, "w") as file:
+                file.write("\n".join(generate_level(width, height, args.seed, args.enemies)))
+            if args.cull == "pvs" and not args.chunked:
+                # generated levels get their potentially visible sets before runs, it is not timed
+                compile_level(path, pvs=True)
+            levels.append(path)
+
+        for path in levels:
+            for render_mode in args.modes:
+                result = run_level(screen, path, render_mode, args.frames, args.rays, args.collision, args.workers,
+                                   args.target_fps, args.entity_mode,
+                                   "none" if args.chunked else args.cull, args.chunked, args.ai)
+                if not args.per_frame:
+                    del result["per_frame"]
+                if path.startswith(tmp_dir):
+                    result["level"] = os.path.basename(path)
+                results.append(result)
+
+    assets_memory = assets.memory_report()
+    pygame.quit()
+
+    output = json.dumps({"dt": DT, "display_resolution": DISPLAY_RESOLUTION, "results": results,
+                         "assets_memory": assets_memory}, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,26 @@
+import os
+
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import argparse
+import glob
+import sys
+from time import perf_counter
+
+from lib import compile_level
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compile level files, load_level compiles stale levels by itself")
+    parser.add_argument("levels", nargs="*", help="level files, levels/*.txt by default")
+    parser.add_argument("--pvs", action="store_true", help="compute potentially visible sets too (slow on big levels, see compute_pvs)")
+    args = parser.parse_args(argv)
+
+    for path in args.levels or sorted(glob.glob("levels/*.txt")):
+        start = perf_counter()
+        out_path = compile_level(path, pvs=args.pvs)
+        print(f"{path} -> {out_path} ({os.path.getsize(out_path)} bytes, {(perf_counter() - start) * 1000:.1f} ms)")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,7 +1,19 @@
 import pygame
+import numpy as np
 from pygame import gfxdraw
 from math import sin, cos, pi, sqrt, ceil, asin
 from typing import Union
+from collections import OrderedDict, deque
+from heapq import heappush, heappop
+from functools import lru_cache
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import perf_counter
+import json
+import os
+import tempfile
+import hashlib
 
 # It is recommended to use 32x48 pixels texture size
 
@@ -13,8 +25,26 @@ RAYS_AMOUNT = 200
 MINIMAP_SCALE = 0.3
 MINIMAP_BLOCK_SIZE = BLOCK_SIZE * MINIMAP_SCALE
 MIN_RENDER_DISTANCE = 10
+MAX_RENDER_DISTANCE = 1000
 ENTITY_SIZE = 50
 ENTITY_HALF_SIZE = ENTITY_SIZE / 2
+SCALED_COLUMNS_CACHE_SIZE = 2048
+DAMAGE_TINT_COLOR = (255, 0, 0, 100)
+# simulation runs with fixed steps independent of frame rate
+SIMULATION_RATE = 120
+SIMULATION_DT = 1 / SIMULATION_RATE
+# steps per frame limit, the rest of time is dropped when rendering can't keep up
+MAX_SIMULATION_STEPS = 8
+# with fewer objects (enemies and player) CollisionGrid costs more than checking walls one by one
+COLLISION_GRID_MIN_OBJECTS = 20
+# threads for parallel compositor, screen columns are split into this many strips. Threads are opt-in:
+# strips were slower with every worker added in benchmarks, raise it only if bench.py --modes parallel
+# --workers N shows a gain on the target machine
+RENDER_WORKERS = 1
+# resolution governor keeps frame time in budget by changing rays amount between these bounds
+TARGET_FRAME_TIME = 1 / 60
+MIN_RAYS_AMOUNT = 80
+MAX_RAYS_AMOUNT = DISPLAY_RESOLUTION[0]
 
 SPAWN_POINT_COLOR = "green"
 ENTITY_1_SPAWN_POINT_COLOR = "red"
@@ -27,31 +57,353 @@ PLAYER_LOOK_LINE_LEN = BLOCK_SIZE * 4 * MINIMAP_SCALE
 PLAYER_COLLISION_SIZE = 15
 PLAYER_SPEED = 70
 PLAYER_RUN_SPEED_MODIFIER = 2
+# chasing enemies shoot from shoot distance, come closer than chase distance and step back if closer than keep one
+CHASE_DISTANCE = 150
+SHOOT_DISTANCE = 350
+KEEP_DISTANCE = 40
+# chasing enemies find paths around walls in this many cells around player, see FlowField
+FLOW_FIELD_RADIUS = 10
+# path steps (dx, dy, cost), diagonal ones are about sqrt(2) times longer
+FLOW_FIELD_STEPS = ((1, 0, 10), (-1, 0, 10), (0, 1, 10), (0, -1, 10), (1, 1, 14), (1, -1, 14), (-1, 1, 14),
+                    (-1, -1, 14))
 DOOR_FRAMES = 5
 DOOR_WIDTH = 2
 
 WALL_SYMS = '#'
 
+# compiled levels, see compile_level
+LEVEL_FORMAT_VERSION = 2
+LEVEL_MAGIC = b"ENTLVL01"
+LEVEL_CACHE_DIR = "__levelcache__"
+CELL_FLOOR = 0
+CELL_WALL = 1
+CELL_PLAYER_SPAWN = 2
+CELL_ENEMY_SPAWN = 3
+# beyond the end of a short row
+CELL_NONE = 255
+# potentially visible sets are stored for square regions of this many cells, see compute_pvs
+PVS_REGION_SIZE = 4
+# pvs occluders are wall faces moved this many pixels into walls, deeper ones need less sample points but
+# widen door ways more
+PVS_OCCLUDER_DEPTH = 18
+# angle resolution of pvs occlusion
+PVS_ANGLE_BINS = 1024
+CELL_SYMBOLS = {"#": CELL_WALL, "@": CELL_PLAYER_SPAWN, "!": CELL_ENEMY_SPAWN}
+CELL_MINIMAP_COLORS = {CELL_FLOOR: FLOOR_COLOR, CELL_WALL: HASH_COLOR, CELL_PLAYER_SPAWN: SPAWN_POINT_COLOR,
+                       CELL_ENEMY_SPAWN: ENTITY_1_SPAWN_POINT_COLOR}
+# bigger levels are compiled without minimap
+MINIMAP_MAX_CELLS = 256 * 256
+# streamed levels, see LevelChunks
+LEVEL_CHUNK_SIZE = 16
+LEVEL_MAX_CHUNKS = 64
+
+# wall sides, same order as wall neighbours
+LEFT_SIDE = 0
+TOP_SIDE = 1
+RIGHT_SIDE = 2
+BOTTOM_SIDE = 3
+
+class AssetRegistry:
+    def __init__(self):
+        # (path, alpha) -> surface, every file is decoded and converted once, on first use
+        self.images = {}
+
+    def image(self, path: str, alpha=False):
+        key = (os.path.normpath(path), alpha)
+        image = self.images.get(key)
+        if image is None:
+            image = pygame.image.load(key[0])
+            image = image.convert_alpha() if alpha else image.convert()
+            self.images[key] = image
+        return image
+
+    def animation(self, directory: str, frames_number: int, alpha=True):
+        # frames are directory/0.png, directory/1.png, ...
+        return [self.image(os.path.join(directory, f"{i}.png"), alpha) for i in range(frames_number)]
+
+    def memory_report(self):
+        # path -> bytes held by its surface
+        report = {}
+        for (path, alpha), image in self.images.items():
+            report[path] = report.get(path, 0) + image.get_pitch() * image.get_height()
+        return report
+
+    def memory_total(self):
+        return sum(self.memory_report().values())
+
+
+# textures shared by walls, entities, weapons and levels
+assets = AssetRegistry()
+
+
+class SimulationClock:
+    # time goes only when it is advanced, so simulation can run faster than real time without display
+    def __init__(self, start=0):
+        self.time = start
+
+    def now(self):
+        return int(self.time)
+
+    def advance(self, ms: float):
+        self.time += ms
+
+
 class AnimatedImage:
-    def __init__(self, frames: list[pygame.Surface], now: int, speed=100):
+    def __init__(self, frames: list[pygame.Surface], now: int, speed=100, tinted_frames: list[pygame.Surface] = None):
         self.frames = frames
+        # same frames with color over them, e.g. while entity is damaged
+        self.tinted_frames = tinted_frames
         self.frames_number = len(frames)
         self.curr_frame_number = 0
         self.animation_speed = speed
         self.last_update = now
     def check_time(self, now: int):
-        now = pygame.time.get_ticks()
         if now - self.last_update > self.animation_speed:
             self.last_update = now
             if self.curr_frame_number == self.frames_number - 1:
                 self.curr_frame_number = 0
             else:
                 self.curr_frame_number += 1
-    def get_cur_texture(self, now: int):
+    def get_cur_texture(self, now: int, tinted=False):
         self.check_time(now)
+        if tinted and self.tinted_frames:
+            return self.tinted_frames[self.curr_frame_number]
         return self.frames[self.curr_frame_number]
 
 
+# (frames, color) -> tinted frames, shared by all images with the same frames
+tinted_frames_cache = {}
+
+
+def get_tinted_frames(frames: list[pygame.Surface], color=DAMAGE_TINT_COLOR):
+    key = (tuple(frames), color)
+    tinted_frames = tinted_frames_cache.get(key)
+    if tinted_frames is None:
+        tinted_frames = []
+        for frame in frames:
+            texture = frame.copy()
+            color_rect = pygame.Surface(texture.get_size()).convert_alpha()
+            color_rect.fill(pygame.Color(*color))
+            texture.blit(color_rect, (0, 0))
+            tinted_frames.append(texture)
+        tinted_frames_cache[key] = tinted_frames
+    return tinted_frames
+
+
+class TextureColumns:
+    def __init__(self, texture: pygame.Surface, scaled_cache_size=SCALED_COLUMNS_CACHE_SIZE):
+        self.texture = texture
+        # one pixel wide subsurfaces share pixels with texture, nothing is copied
+        self.columns = [texture.subsurface((x, 0, 1, texture.get_height())) for x in range(texture.get_width())]
+        # (pixel_row, width, height) -> scaled column, least recently used first
+        self.scaled = OrderedDict()
+        self.scaled_cache_size = scaled_cache_size
+
+    def get_column(self, pixel_row: int):
+        return self.columns[pixel_row]
+
+    def get_scaled(self, pixel_row: int, size: tuple):
+        key = (pixel_row, int(size[0]), int(size[1]))
+        column = self.scaled.get(key)
+        if column is None:
+            column = pygame.transform.scale(self.columns[pixel_row], key[1:])
+            # columns taller than screen are rare and big, don't keep them
+            if key[2] <= DISPLAY_RESOLUTION[1]:
+                self.scaled[key] = column
+                if len(self.scaled) > self.scaled_cache_size:
+                    self.scaled.popitem(last=False)
+        else:
+            self.scaled.move_to_end(key)
+        return column
+
+
+# texture -> TextureColumns
+texture_columns_cache = {}
+
+
+def get_texture_columns(texture: pygame.Surface):
+    columns = texture_columns_cache.get(texture)
+    if columns is None:
+        columns = TextureColumns(texture)
+        texture_columns_cache[texture] = columns
+    return columns
+
+
+def scale_column(line: pygame.Surface, size: tuple):
+    # columns of cached textures are scaled through their LRU, other surfaces are scaled directly
+    columns = texture_columns_cache.get(line.get_parent())
+    if columns is not None:
+        return columns.get_scaled(line.get_offset()[0], size)
+    return pygame.transform.scale(line, size)
+
+
+def draw_column(target: pygame.Surface, line: pygame.Surface, width: int, height: float,
+                screen_height=DISPLAY_RESOLUTION[1]):
+    # blits line scaled to height and centered on screen_height, for columns taller than screen only texture rows
+    # that get on screen are scaled, so work is capped by screen height
+    top = (screen_height - height) / 2
+    if height <= screen_height:
+        target.blit(scale_column(line, (width, height)), (0, top))
+        return
+    texture_height = line.get_height()
+    texel = height / texture_height
+    first = max(0, int(-top // texel))
+    last = min(texture_height, ceil((screen_height - top) / texel))
+    if first >= last:
+        return
+    visible = line.subsurface((0, first, line.get_width(), last - first))
+    target.blit(pygame.transform.scale(visible, (width, round((last - first) * texel))), (0, top + first * texel))
+
+
+class ProfilerStage:
+    def __init__(self, profiler: "FrameProfiler", name: str):
+        self.profiler = profiler
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.add(self.name, self.start, perf_counter())
+
+
+class FrameProfiler:
+    def __init__(self, history=300, detailed=False, trace_frames=600):
+        # rolling window of per frame stage times, seconds
+        self.history = history
+        self.stats = {}
+        # stage -> seconds spent in the current frame
+        self.current = {}
+        # time ray casting sub-phases too (walls, entities, projectiles), see set_profiler
+        self.detailed = detailed
+        # chrome trace events of last frames
+        self.trace = deque(maxlen=trace_frames * 16)
+        self.sub_phases = set()
+        self.start_time = perf_counter()
+        self.frame_start = None
+        self.frames_number = 0
+        self.show_overlay = False
+        self.overlay = None
+        self.overlay_update_period = 15
+        self.font = None
+
+    def begin_frame(self):
+        self.frame_start = perf_counter()
+        self.current = {}
+
+    def end_frame(self):
+        end = perf_counter()
+        if self.frame_start is not None:
+            self.add("frame", self.frame_start, end)
+        for name, value in self.current.items():
+            if name not in self.stats:
+                self.stats[name] = deque(maxlen=self.history)
+            self.stats[name].append(value)
+            if name in self.sub_phases:
+                self.trace.append(("C", name, end, value))
+        self.frames_number += 1
+
+    def stage(self, name: str):
+        return ProfilerStage(self, name)
+
+    def add(self, name: str, start: float, end: float):
+        self.current[name] = self.current.get(name, 0.0) + end - start
+        self.trace.append(("X", name, start, end))
+
+    def add_time(self, name: str, seconds: float):
+        # sub-phases are summed over the frame and traced as counters at the frame end
+        self.current[name] = self.current.get(name, 0.0) + seconds
+        self.sub_phases.add(name)
+
+    def percentile(self, name: str, q: float):
+        values = sorted(self.stats.get(name, ()))
+        if not values:
+            return 0.0
+        return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+    def report(self):
+        # stage -> (p50, p95, p99) in seconds
+        return {name: (self.percentile(name, 50), self.percentile(name, 95), self.percentile(name, 99))
+                for name in self.stats}
+
+    def draw_overlay(self, screen: pygame.Surface, pos: tuple):
+        if not self.show_overlay:
+            return
+        if self.overlay is None or self.frames_number % self.overlay_update_period == 0:
+            if self.font is None:
+                self.font = pygame.font.SysFont("monospace", 14)
+            lines = [f"{'stage':<16}{'p50':>7}{'p95':>7}{'p99':>7} ms"]
+            for name, values in self.report().items():
+                lines.append(f"{name:<16}" + "".join(f"{value * 1000:>7.2f}" for value in values))
+            line_height = self.font.get_linesize()
+            width = max(self.font.size(line)[0] for line in lines)
+            self.overlay = pygame.Surface((width + 8, line_height * len(lines) + 8), pygame.SRCALPHA)
+            self.overlay.fill((0, 0, 0, 160))
+            for i, line in enumerate(lines):
+                self.overlay.blit(self.font.render(line, True, "white"), (4, 4 + i * line_height))
+        screen.blit(self.overlay, pos)
+
+    def dump_trace(self, path: str):
+        # chrome://tracing / perfetto json, frame stages and per frame sub-phase counters
+        events = []
+        for phase, name, start, value in self.trace:
+            if phase == "X":
+                events.append({"name": name, "ph": "X", "pid": 0, "tid": 0,
+                               "ts": (start - self.start_time) * 1e6, "dur": (value - start) * 1e6})
+            else:
+                events.append({"name": name, "ph": "C", "pid": 0, "tid": 0,
+                               "ts": (start - self.start_time) * 1e6, "args": {"ms": value * 1000}})
+        with open(path, "w") as file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file)
+
+
+# profiler for ray casting sub-phases, None if profiling is off
+profiler = None
+
+
+def set_profiler(new_profiler: FrameProfiler):
+    global profiler
+    profiler = new_profiler
+
+
+class ResolutionGovernor:
+    def __init__(self, target_frame_time=TARGET_FRAME_TIME, min_rays=MIN_RAYS_AMOUNT, max_rays=MAX_RAYS_AMOUNT,
+                 rays_amount=RAYS_AMOUNT, window=30, lower=0.75, upper=0.95, decrease=0.85, increase=1.1):
+        # rays are taken away when mean frame time is over upper part of the budget and added back when it is
+        # under lower part (if frame time after that is expected to stay under upper part),
+        # between them nothing changes, so quality doesn't oscillate
+        self.target_frame_time = target_frame_time
+        self.min_rays = min_rays
+        self.max_rays = max_rays
+        self.rays_amount = min(max(rays_amount, min_rays), max_rays)
+        self.lower = lower
+        self.upper = upper
+        self.decrease = decrease
+        self.increase = increase
+        self.frame_times = deque(maxlen=window)
+
+    def update(self, frame_time: float):
+        # frame_time is work time of the last frame in seconds, returns rays amount for the next frame
+        self.frame_times.append(frame_time)
+        if len(self.frame_times) < self.frame_times.maxlen:
+            return self.rays_amount
+        mean = sum(self.frame_times) / len(self.frame_times)
+        if mean > self.target_frame_time * self.upper:
+            rays_amount = max(self.min_rays, int(self.rays_amount * self.decrease))
+        elif mean < self.target_frame_time * self.lower and \
+                mean * self.increase < self.target_frame_time * self.upper:
+            rays_amount = min(self.max_rays, ceil(self.rays_amount * self.increase))
+        else:
+            rays_amount = self.rays_amount
+        if rays_amount != self.rays_amount:
+            # frame times measured with old rays amount are not used
+            self.rays_amount = rays_amount
+            self.frame_times.clear()
+        return self.rays_amount
+
+
 class EntityBasicClass:
     def __init__(self, pos: pygame.Vector2, speed: int, health=100):
         self.pos = pos
@@ -64,6 +416,9 @@ class EntityBasicClass:
         self.vel = pygame.Vector2(0, 0)
 
     def check_collision(self, level: list):
+        if isinstance(level, CellGrid):
+            level.check_collision(self)
+            return
         x, y = self.cur_block()
 
         if 0 < x < len(level[0]) - 1 and 0 < y < len(level) - 1:
@@ -76,7 +431,7 @@ class EntityBasicClass:
             level[y][x + 1].check_collision(self)
             level[y + 1][x].check_collision(self)
 
-    def update_ai(self, player: "Player", projectiles: list, dt: int, now: int):
+    def update_ai(self, player: "Player", projectiles: list, dt: int, now: int, flow_field: "FlowField" = None):
         pass
 
     def deal_damage(self, damage: int, now: int):
@@ -111,48 +466,189 @@ class Player(EntityBasicClass):
         return self.weapons[self.curr_weapon_number]
 
 
+class ColumnStore:
+    # objects state as numpy columns (name, shape of item, dtype) with free slots reuse, COLUMNS must have
+    # alive column. Subclasses keep their per slot python objects in grow_slots
+    COLUMNS = ()
+
+    def __init__(self, capacity: int):
+        self.capacity = 0
+        # slots below count were used, free ones are reused first, the oldest freed first
+        self.count = 0
+        self.free = deque()
+        for name, shape, dtype in self.COLUMNS:
+            setattr(self, name, np.zeros((0, *shape), dtype=dtype))
+        self.grow(capacity)
+
+    def grow(self, capacity: int):
+        for name, shape, dtype in self.COLUMNS:
+            column = np.zeros((capacity, *shape), dtype=dtype)
+            column[:self.capacity] = getattr(self, name)
+            setattr(self, name, column)
+        self.grow_slots(self.capacity, capacity)
+        self.capacity = capacity
+
+    def grow_slots(self, start: int, end: int):
+        pass
+
+    def new_slot(self):
+        # free slot or the next unused one, columns are doubled when all are used
+        if self.free:
+            return self.free.popleft()
+        if self.count == self.capacity:
+            self.grow(max(1, self.capacity * 2))
+        self.count += 1
+        return self.count - 1
+
+    def slots(self):
+        return np.nonzero(self.alive[:self.count])[0]
+
+    def __len__(self):
+        return int(np.count_nonzero(self.alive[:self.count]))
+
+
+class EntityStore(ColumnStore):
+    # enemies state as numpy columns (name, shape of item, dtype), Enemy objects are views of their slots
+    COLUMNS = (
+        ("pos", (2,), float),
+        ("vel", (2,), float),
+        ("speed", (), float),
+        ("health", (), np.int64),
+        ("weapon_time", (), np.int64),
+        ("weapon_speed", (), np.int64),
+        ("alive", (), bool),
+        ("chasing", (), bool),
+    )
+
+    def __init__(self, capacity=64):
+        # slot -> entity
+        self.entities = []
+        super().__init__(capacity)
+
+    def grow_slots(self, start: int, end: int):
+        self.entities.extend([None] * (end - start))
+
+    def add(self, entity: "Enemy"):
+        slot = self.new_slot()
+        for name, shape, dtype in self.COLUMNS:
+            getattr(self, name)[slot] = 0
+        self.alive[slot] = True
+        self.entities[slot] = entity
+        return slot
+
+    def remove(self, entity: "Enemy"):
+        # removed entity keeps its state in its own store, so the slot can be reused
+        slot = entity.slot
+        own = EntityStore(1)
+        own.add(entity)
+        for name, shape, dtype in self.COLUMNS:
+            getattr(own, name)[0] = getattr(self, name)[slot]
+        entity.store, entity.slot = own, 0
+        self.alive[slot] = False
+        self.entities[slot] = None
+        self.free.append(slot)
+
+    def update_ai(self, player: "Player", projectiles: list, dt: int, now: int, flow_field: "FlowField" = None):
+        # chasing enemies are updated all at once, others one by one
+        slots = self.slots()
+        chasing_slots = self.chasing[slots]
+        chasing_batch(self, slots[chasing_slots], player, projectiles, dt, now, flow_field)
+        for slot in slots[~chasing_slots].tolist():
+            self.entities[slot].update_ai(player, projectiles, dt, now, flow_field)
+
+
 class Enemy(EntityBasicClass):
-    def __init__(self, pos: pygame.Vector2, speed: int, frames: list[pygame.Surface], ai, now):
+    def __init__(self, pos: pygame.Vector2, speed: int, frames: list[pygame.Surface], ai, now,
+                 store: EntityStore = None):
+        # position, velocity, speed, health and weapon cooldown live in store, enemy without store gets its own
+        self.store = store if store is not None else EntityStore(1)
+        self.slot = self.store.add(self)
         super().__init__(pos, speed)
         self.ai = ai
-        self.texture = AnimatedImage(frames, now)
+        self.store.chasing[self.slot] = ai is chasing
+        self.texture = AnimatedImage(frames, now, tinted_frames=get_tinted_frames(frames))
         self.damage_time = None
         self.damage_duration = 300
         self.weapon = None
-    def update_ai(self, player: Player, projectiles: list, dt: int, now: int):
-        self.ai(self, player, projectiles, dt, now)
+    @property
+    def pos(self):
+        x, y = self.store.pos[self.slot].tolist()
+        return pygame.Vector2(x, y)
+
+    @pos.setter
+    def pos(self, value: pygame.Vector2):
+        self.store.pos[self.slot] = (value[0], value[1])
+
+    @property
+    def vel(self):
+        x, y = self.store.vel[self.slot].tolist()
+        return pygame.Vector2(x, y)
+
+    @vel.setter
+    def vel(self, value: pygame.Vector2):
+        self.store.vel[self.slot] = (value[0], value[1])
+
+    @property
+    def speed(self):
+        return float(self.store.speed[self.slot])
+
+    @speed.setter
+    def speed(self, value: float):
+        self.store.speed[self.slot] = value
+
+    @property
+    def health(self):
+        return int(self.store.health[self.slot])
+
+    @health.setter
+    def health(self, value: int):
+        self.store.health[self.slot] = value
+
+    def update_ai(self, player: Player, projectiles: list, dt: int, now: int, flow_field: "FlowField" = None):
+        self.ai(self, player, projectiles, dt, now, flow_field)
     def deal_damage(self, damage: int, now: int):
         self.health -= damage
-        self.damage_time = pygame.time.get_ticks()
+        self.damage_time = now
     def get_cur_texture(self, now: int):
-        now = pygame.time.get_ticks()
-
         if not (self.damage_time is None):
             if now - self.damage_time >= self.damage_duration:
                 self.damage_time = None
             else:
-                texture = self.texture.get_cur_texture(now).copy()
-                red_rect = pygame.Surface(texture.get_size()).convert_alpha()
-                red_rect.fill(pygame.Color(255, 0, 0, 100))
-                texture.blit(red_rect, (0, 0))
-                return texture
+                return self.texture.get_cur_texture(now, tinted=True)
         return self.texture.get_cur_texture(now)
     def get_look_ang(self, player: "Player"):
         return asin((self.pos - player.pos).normalize().y)
 
 class EntityWeaponClass:
     def __init__(self, user: Enemy, speed: int,  now: int, damage: int):
+        self.user = user
         self.start_time = now
         self.use_speed = speed
-        self.user = user
         self.damage = damage
-    def use(self, now: int, player: "Player"):
+
+    # cooldown is kept in user's store
+    @property
+    def start_time(self):
+        return int(self.user.store.weapon_time[self.user.slot])
+
+    @start_time.setter
+    def start_time(self, value: int):
+        self.user.store.weapon_time[self.user.slot] = value
+
+    @property
+    def use_speed(self):
+        return int(self.user.store.weapon_speed[self.user.slot])
+
+    @use_speed.setter
+    def use_speed(self, value: int):
+        self.user.store.weapon_speed[self.user.slot] = value
+
+    def use(self, now: int, player: "Player", projectiles):
+        # returns the shot added to projectiles if weapon is ready
         if now - self.start_time >= self.use_speed:
             self.start_time = now
             direction = -(self.user.pos - player.pos).normalize()
-            proj = Projectile(self.user.pos, direction, now, self.damage)
-            proj.damaged_entities.append(self.user)
-            return proj
+            return shoot(projectiles, self.user, direction, now, self.damage)
         return None
 
 
@@ -164,15 +660,13 @@ class Weapon:
         self.user = user
         self.damage = damage
         self.is_active = False
-    def use(self, now: int):
+    def use(self, now: int, projectiles):
         if self.is_active:
             if now - self.start_time >= self.use_speed:
                 self.is_active = False
                 ang = self.user.look_ang
                 direction = pygame.Vector2(cos(ang), -sin(ang))
-                proj = Projectile(self.user.pos, direction, now, self.damage)
-                proj.damaged_entities.append(self.user)
-                return proj
+                return shoot(projectiles, self.user, direction, now, self.damage)
         return None
 
     def get_cur_texture(self, now: int):
@@ -183,10 +677,7 @@ class Weapon:
 
 class LaserGun(Weapon):
     def __init__(self, user: Player, now: int):
-        frames = []
-        for i in range(3):
-            image = pygame.image.load("textures/lasergun/" + str(i) + ".png")
-            frames.append(image.convert_alpha())
+        frames = assets.animation("textures/lasergun", 3)
         super().__init__(user, 800, frames, now, 20)
 
 class PelmenLaserGun(EntityWeaponClass):
@@ -206,9 +697,8 @@ class Projectile:
         self.damage = damage
         # unit vector with right direction
         self.direction = direction
-        self.damaged_entities = []
-    def update(self, dt: int):
-        now = pygame.time.get_ticks()
+        self.damaged_entities = set()
+    def update(self, dt: int, now: int):
         if now - self.time < self.decay_time:
             self.pos += self.direction * dt * self.speed
             return self
@@ -218,11 +708,197 @@ class Projectile:
         return (self.pos, self.direction, self.length), (self.pos - rotated * self.width / 2, rotated, self.width)
 
 
+class PooledProjectile:
+    # view of projectile pool slot, one per slot for all pool lifetime
+    __slots__ = ("pool", "slot")
+    decay_time = 2000
+    speed = 200
+    color = "red"
+    length = 20
+    width = 2
+
+    def __init__(self, pool: "ProjectilePool", slot: int):
+        self.pool = pool
+        self.slot = slot
+
+    @property
+    def pos(self):
+        x, y = self.pool.pos[self.slot].tolist()
+        return pygame.Vector2(x, y)
+
+    @pos.setter
+    def pos(self, value: pygame.Vector2):
+        self.pool.pos[self.slot] = (value[0], value[1])
+
+    @property
+    def direction(self):
+        x, y = self.pool.direction[self.slot].tolist()
+        return pygame.Vector2(x, y)
+
+    @property
+    def time(self):
+        return int(self.pool.time[self.slot])
+
+    @property
+    def damage(self):
+        return int(self.pool.damage[self.slot])
+
+    @property
+    def damaged_entities(self):
+        return self.pool.damaged_entities[self.slot]
+
+    get_lines = Projectile.get_lines
+
+
+class ProjectilePool(ColumnStore):
+    # projectiles as numpy columns (name, shape of item, dtype) with free slots reuse,
+    # weapons spawn shots right into slots (see shoot), iteration gives views of alive slots.
+    # The oldest freed slots are reused first, so the last step positions of new shots are not mixed up
+    COLUMNS = (
+        ("pos", (2,), float),
+        ("direction", (2,), float),
+        ("time", (), np.int64),
+        ("damage", (), np.int64),
+        ("alive", (), bool),
+    )
+
+    def __init__(self, capacity=256):
+        self.views = []
+        self.damaged_entities = []
+        super().__init__(capacity)
+
+    def grow_slots(self, start: int, end: int):
+        self.views.extend(PooledProjectile(self, slot) for slot in range(start, end))
+        self.damaged_entities.extend(set() for _ in range(start, end))
+
+    def spawn(self, pos: pygame.Vector2, direction: pygame.Vector2, now: int, damage: int):
+        slot = self.new_slot()
+        self.pos[slot] = (pos.x, pos.y)
+        self.direction[slot] = (direction.x, direction.y)
+        self.time[slot] = now
+        self.damage[slot] = damage
+        self.alive[slot] = True
+        self.damaged_entities[slot].clear()
+        return self.views[slot]
+
+    def append(self, proj: Projectile):
+        # for code written for projectiles list, Projectile is copied into a slot
+        view = self.spawn(proj.pos, proj.direction, proj.time, proj.damage)
+        view.damaged_entities.update(proj.damaged_entities)
+
+    def update(self, dt: int, now: int):
+        # expired projectiles free their slots, the rest move
+        slots = self.slots()
+        expired = now - self.time[slots] >= PooledProjectile.decay_time
+        if expired.any():
+            self.alive[slots[expired]] = False
+            self.free.extend(slots[expired].tolist())
+            slots = slots[~expired]
+        self.pos[slots] += self.direction[slots] * (dt * PooledProjectile.speed)
+        return slots
+
+    def __iter__(self):
+        return iter([self.views[slot] for slot in self.slots().tolist()])
+
+
+def shoot(projectiles, user, direction: pygame.Vector2, now: int, damage: int):
+    # new shot of user, pool slot is filled in place, list gets a new Projectile
+    if isinstance(projectiles, ProjectilePool):
+        proj = projectiles.spawn(user.pos + direction, direction, now, damage)
+    else:
+        proj = Projectile(user.pos, direction, now, damage)
+        projectiles.append(proj)
+    proj.damaged_entities.add(user)
+    return proj
+
+
+def wall_collision_left(left: float, top: float, obj: Player):
+    if top <= obj.pos.y <= top + BLOCK_SIZE:
+        if left - PLAYER_COLLISION_SIZE <= obj.pos.x <= left:
+            if obj.vel.x > 0:
+                obj.vel += pygame.Vector2(-obj.vel.x, 0)
+
+
+def wall_collision_top(left: float, top: float, obj: Player):
+    if left <= obj.pos.x <= left + BLOCK_SIZE:
+        if top - PLAYER_COLLISION_SIZE <= obj.pos.y <= top:
+            if obj.vel.y > 0:
+                obj.vel += pygame.Vector2(0, -obj.vel.y)
+
+
+def wall_collision_right(left: float, top: float, obj: Player):
+    if top <= obj.pos.y <= top + BLOCK_SIZE:
+        if left + BLOCK_SIZE <= obj.pos.x <= left + BLOCK_SIZE + PLAYER_COLLISION_SIZE:
+            if obj.vel.x < 0:
+                obj.vel += pygame.Vector2(-obj.vel.x, 0)
+
+
+def wall_collision_bottom(left: float, top: float, obj: Player):
+    if left <= obj.pos.x <= left + BLOCK_SIZE:
+        if top + BLOCK_SIZE <= obj.pos.y <= top + BLOCK_SIZE + PLAYER_COLLISION_SIZE:
+            if obj.vel.y < 0:
+                obj.vel += pygame.Vector2(0, -obj.vel.y)
+
+
+def push_from_corner(vec: pygame.Vector2, obj: Player):
+    # removes part of velocity going into the corner
+    if vec.dot(obj.vel) > 0:
+        vec.scale_to_length(vec.dot(obj.vel) / (vec.magnitude() * obj.vel.magnitude()) * obj.vel.magnitude())
+        obj.vel -= vec
+
+
+def wall_collision_top_left(left: float, top: float, obj: Player):
+    if left - PLAYER_COLLISION_SIZE < obj.pos.x < left:
+        if top - PLAYER_COLLISION_SIZE < obj.pos.y < top:
+            push_from_corner(pygame.Vector2(1, 1), obj)
+
+
+def wall_collision_top_right(left: float, top: float, obj: Player):
+    if left + BLOCK_SIZE < obj.pos.x < left + BLOCK_SIZE + PLAYER_COLLISION_SIZE:
+        if top - PLAYER_COLLISION_SIZE < obj.pos.y < top:
+            push_from_corner(pygame.Vector2(-1, 1), obj)
+
+
+def wall_collision_bottom_right(left: float, top: float, obj: Player):
+    if left + BLOCK_SIZE < obj.pos.x < left + BLOCK_SIZE + PLAYER_COLLISION_SIZE:
+        if top + BLOCK_SIZE < obj.pos.y < top + BLOCK_SIZE + PLAYER_COLLISION_SIZE:
+            push_from_corner(pygame.Vector2(-1, -1), obj)
+
+
+def wall_collision_bottom_left(left: float, top: float, obj: Player):
+    if left - PLAYER_COLLISION_SIZE < obj.pos.x < left:
+        if top + BLOCK_SIZE < obj.pos.y < top + BLOCK_SIZE + PLAYER_COLLISION_SIZE:
+            push_from_corner(pygame.Vector2(1, -1), obj)
+
+
+def wall_collisions(edges: int):
+    # collision areas of a wall with exposed sides edges (bits 1 << side), corners need both of their sides
+    sides = (
+        (1 << LEFT_SIDE, wall_collision_left),
+        (1 << TOP_SIDE, wall_collision_top),
+        (1 << RIGHT_SIDE, wall_collision_right),
+        (1 << BOTTOM_SIDE, wall_collision_bottom),
+        (1 << LEFT_SIDE | 1 << TOP_SIDE, wall_collision_top_left),
+        (1 << TOP_SIDE | 1 << RIGHT_SIDE, wall_collision_top_right),
+        (1 << RIGHT_SIDE | 1 << BOTTOM_SIDE, wall_collision_bottom_right),
+        (1 << BOTTOM_SIDE | 1 << LEFT_SIDE, wall_collision_bottom_left),
+    )
+    return tuple(collision for bits, collision in sides if edges & bits == bits)
+
+
+# collision functions for every combination of exposed sides, shared by all walls and wall cells
+WALL_COLLISIONS = tuple(wall_collisions(edges) for edges in range(16))
+
+
 class Wall:
+    # there can be many walls, so they have no __dict__ and no per wall collision closures
+    __slots__ = ("pos", "type", "texture", "columns", "sides", "edges", "edge_bits")
+
     def __init__(self, pos: pygame.Vector2, block_type: str, neighbours: tuple, texture: pygame.Surface):
         self.pos = pos
         self.type = block_type
         self.texture = texture
+        self.columns = get_texture_columns(texture)
 
         # wall points
         top_left = (pos.x - BLOCK_SIZE / 2, pos.y - BLOCK_SIZE / 2)
@@ -230,93 +906,75 @@ class Wall:
         bottom_right = (pos.x + BLOCK_SIZE / 2, pos.y + BLOCK_SIZE / 2)
         bottom_left = (pos.x - BLOCK_SIZE / 2, pos.y + BLOCK_SIZE / 2)
 
-        # collision areas
-        def bottom(obj: Player):
-            if self.pos.x - BLOCK_SIZE / 2 <= obj.pos.x <= self.pos.x + BLOCK_SIZE / 2:
-                if self.pos.y + BLOCK_SIZE / 2 <= obj.pos.y <= self.pos.y + BLOCK_SIZE / 2 + PLAYER_COLLISION_SIZE:
-                    if obj.vel.y < 0:
-                        obj.vel += pygame.Vector2(0, -obj.vel.y)
-        def top(obj: Player):
-            if self.pos.x - BLOCK_SIZE / 2 <= obj.pos.x <= self.pos.x + BLOCK_SIZE / 2:
-                if self.pos.y - BLOCK_SIZE / 2 - PLAYER_COLLISION_SIZE <= obj.pos.y <= self.pos.y - BLOCK_SIZE / 2:
-                    if obj.vel.y > 0:
-                        obj.vel += pygame.Vector2(0, -obj.vel.y)
-        def left(obj: Player):
-            if self.pos.y - BLOCK_SIZE / 2 <= obj.pos.y <= self.pos.y + BLOCK_SIZE / 2:
-                if self.pos.x - BLOCK_SIZE / 2 - PLAYER_COLLISION_SIZE <= obj.pos.x <= self.pos.x - BLOCK_SIZE / 2:
-                    if obj.vel.x > 0:
-                        obj.vel += pygame.Vector2(-obj.vel.x, 0)
-        def right(obj: Player):
-            if self.pos.y - BLOCK_SIZE / 2 <= obj.pos.y <= self.pos.y + BLOCK_SIZE / 2:
-                if self.pos.x + BLOCK_SIZE / 2 <= obj.pos.x <= self.pos.x + BLOCK_SIZE / 2 + PLAYER_COLLISION_SIZE:
-                    if obj.vel.x < 0:
-                        obj.vel += pygame.Vector2(-obj.vel.x, 0)
-        def bottomleft(obj: Player):
-            if self.pos.x - BLOCK_SIZE / 2 - PLAYER_COLLISION_SIZE < obj.pos.x < self.pos.x - BLOCK_SIZE / 2:
-                if self.pos.y + BLOCK_SIZE / 2 < obj.pos.y < self.pos.y + BLOCK_SIZE / 2 + PLAYER_COLLISION_SIZE:
-                    vec = pygame.Vector2(1, -1)
-                    if vec.dot(obj.vel) > 0:
-                        vec.scale_to_length(
-                            vec.dot(obj.vel) / (vec.magnitude() * obj.vel.magnitude()) * obj.vel.magnitude())
-                        obj.vel -= vec
-        def topleft(obj: Player):
-            if self.pos.x - BLOCK_SIZE / 2 - PLAYER_COLLISION_SIZE < obj.pos.x < self.pos.x - BLOCK_SIZE / 2:
-                if self.pos.y - BLOCK_SIZE / 2 - PLAYER_COLLISION_SIZE < obj.pos.y < self.pos.y - BLOCK_SIZE / 2:
-                    vec = pygame.Vector2(1, 1)
-                    if vec.dot(obj.vel) > 0:
-                        vec.scale_to_length(
-                            vec.dot(obj.vel) / (vec.magnitude() * obj.vel.magnitude()) * obj.vel.magnitude())
-                        obj.vel -= vec
-        def bottomright(obj: Player):
-            if self.pos.x + BLOCK_SIZE / 2 < obj.pos.x < self.pos.x + BLOCK_SIZE / 2 + PLAYER_COLLISION_SIZE:
-                if self.pos.y + BLOCK_SIZE / 2 < obj.pos.y < self.pos.y + BLOCK_SIZE / 2 + PLAYER_COLLISION_SIZE:
-                    vec = pygame.Vector2(-1, -1)
-                    if vec.dot(obj.vel) > 0:
-                        vec.scale_to_length(
-                            vec.dot(obj.vel) / (vec.magnitude() * obj.vel.magnitude()) * obj.vel.magnitude())
-                        obj.vel -= vec
-        def topright(obj: Player):
-            if self.pos.x + BLOCK_SIZE / 2 < obj.pos.x < self.pos.x + BLOCK_SIZE / 2 + PLAYER_COLLISION_SIZE:
-                if self.pos.y - BLOCK_SIZE / 2 - PLAYER_COLLISION_SIZE < obj.pos.y < self.pos.y - BLOCK_SIZE / 2:
-                    vec = pygame.Vector2(-1, 1)
-                    if vec.dot(obj.vel) > 0:
-                        vec.scale_to_length(
-                            vec.dot(obj.vel) / (vec.magnitude() * obj.vel.magnitude()) * obj.vel.magnitude())
-                        obj.vel -= vec
-
-        connections = set()
-        collisions = set()
-        # left side check
-        if neighbours[0]:
-            connections.add((bottom_left, top_left))
-            collisions.add(left)
-        # top side check
-        if neighbours[1]:
-            connections.add((top_left, top_right))
-            collisions.add(top)
-        # right side check
-        if neighbours[2]:
-            connections.add((top_right, bottom_right))
-            collisions.add(right)
-        # bottom side check
-        if neighbours[3]:
-            connections.add((bottom_right, bottom_left))
-            collisions.add(bottom)
-
-        if neighbours[0] and neighbours[1]:
-            collisions.add(topleft)
-        if neighbours[1] and neighbours[2]:
-            collisions.add(topright)
-        if neighbours[2] and neighbours[3]:
-            collisions.add(bottomright)
-        if neighbours[3] and neighbours[0]:
-            collisions.add(bottomleft)
-
-        self.sides = tuple(connections)
-        self.collisions = tuple(collisions)
+        # exposed sides by direction, None if side is covered by neighbour
+        edges = [None, None, None, None]
+        if neighbours[LEFT_SIDE]:
+            edges[LEFT_SIDE] = (bottom_left, top_left)
+        if neighbours[TOP_SIDE]:
+            edges[TOP_SIDE] = (top_left, top_right)
+        if neighbours[RIGHT_SIDE]:
+            edges[RIGHT_SIDE] = (top_right, bottom_right)
+        if neighbours[BOTTOM_SIDE]:
+            edges[BOTTOM_SIDE] = (bottom_right, bottom_left)
+
+        self.sides = tuple(side for side in edges if side is not None)
+        self.edges = tuple(edges)
+        self.edge_bits = sum(1 << side for side in range(4) if neighbours[side])
+
     def check_collision(self, obj: Player):
-        for collision in self.collisions:
-            collision(obj)
+        for collision in WALL_COLLISIONS[self.edge_bits]:
+            collision(self.pos.x - BLOCK_SIZE / 2, self.pos.y - BLOCK_SIZE / 2, obj)
+
+
+class WallSegment:
+    def __init__(self, direction: int, walls: list[Wall]):
+        # contiguous exposed sides of walls facing the same direction, walls are ordered from segment start,
+        # which goes the same way as their sides, so texture offset is kept for every block
+        if direction in (LEFT_SIDE, BOTTOM_SIDE):
+            walls = walls[::-1]
+        self.direction = direction
+        self.walls = walls
+        self.start = walls[0].edges[direction][0]
+        self.end = walls[-1].edges[direction][1]
+        self.is_vertical = direction in (LEFT_SIDE, RIGHT_SIDE)
+
+    def get_block(self, inter: pygame.Vector2):
+        # wall and its side under point of segment
+        if self.is_vertical:
+            dst = abs(inter.y - self.start[1])
+        else:
+            dst = abs(inter.x - self.start[0])
+        wall = self.walls[min(int(dst // BLOCK_SIZE), len(self.walls) - 1)]
+        return wall, wall.edges[self.direction]
+
+
+def merge_wall_sides(walls: list[Wall]):
+    # merges collinear contiguous exposed sides into WallSegment
+    lines = {}
+    for wall in walls:
+        for direction, side in enumerate(wall.edges):
+            if side is None:
+                continue
+            if direction in (LEFT_SIDE, RIGHT_SIDE):
+                key = (direction, side[0][0])
+                along = min(side[0][1], side[1][1])
+            else:
+                key = (direction, side[0][1])
+                along = min(side[0][0], side[1][0])
+            lines.setdefault(key, []).append((along, wall))
+
+    segments = []
+    for (direction, coord), pieces in lines.items():
+        pieces.sort(key=lambda piece: piece[0])
+        run = [pieces[0]]
+        for piece in pieces[1:]:
+            if piece[0] == run[-1][0] + BLOCK_SIZE:
+                run.append(piece)
+            else:
+                segments.append(WallSegment(direction, [wall for along, wall in run]))
+                run = [piece]
+        segments.append(WallSegment(direction, [wall for along, wall in run]))
+    return segments
 
 
 class FloorBlock:
@@ -344,77 +1002,506 @@ class SpawnBlockEnemy:
         self.entity_ai = ai
     def check_collision(self, obj):
         pass
-    def spawn_entity(self, now: int):
-        return init_enemy(self.pos, self.entity_frames, self.entity_speed, self.entity_ai, now)
+    def spawn_entity(self, now: int, store: EntityStore = None):
+        return init_enemy(self.pos, self.entity_frames, self.entity_speed, self.entity_ai, now, store)
+
+def parse_level(level_data: list):
+    # cell types grid, rows shorter than the longest one are filled with CELL_NONE
+    cells = np.full((len(level_data), max(len(row) for row in level_data)), CELL_NONE, dtype=np.uint8)
+    for y in range(len(level_data)):
+        cells[y, :len(level_data[y])] = [CELL_SYMBOLS.get(sym, CELL_FLOOR) for sym in level_data[y]]
+    return cells
+
+
+def find_wall_edges(cells: np.ndarray):
+    # bit 1 << side is set if the wall side has an existing not wall neighbour
+    walls = cells == CELL_WALL
+    open_cells = np.pad((cells != CELL_WALL) & (cells != CELL_NONE), 1, constant_values=False)
+    edges = np.zeros(cells.shape, dtype=np.uint8)
+    edges |= (walls & open_cells[1:-1, :-2]).astype(np.uint8) << LEFT_SIDE
+    edges |= (walls & open_cells[:-2, 1:-1]).astype(np.uint8) << TOP_SIDE
+    edges |= (walls & open_cells[1:-1, 2:]).astype(np.uint8) << RIGHT_SIDE
+    edges |= (walls & open_cells[2:, 1:-1]).astype(np.uint8) << BOTTOM_SIDE
+    return edges
+
+
+def render_minimap(cells: np.ndarray, width: int):
+    minimap = pygame.Surface((width * MINIMAP_BLOCK_SIZE, cells.shape[0] * MINIMAP_BLOCK_SIZE))
+    for y, row in enumerate(cells.tolist()):
+        for x, cell in enumerate(row):
+            if cell != CELL_NONE:
+                minimap_block = pygame.Rect(x * MINIMAP_BLOCK_SIZE, y * MINIMAP_BLOCK_SIZE, MINIMAP_BLOCK_SIZE,
+                                            MINIMAP_BLOCK_SIZE)
+                pygame.draw.rect(minimap, CELL_MINIMAP_COLORS[cell], minimap_block)
+    return pygame.surfarray.array3d(minimap)
+
+
+def wall_occluders(solid: np.ndarray, edges: np.ndarray, depth: int):
+    # exposed wall faces merged along rows and columns and moved depth pixels into the walls, so every point
+    # closer than depth to them is in a wall: runs ends are shortened by depth if the wall ends there and
+    # lengthened if it goes on and turns. solid has one more cell on every side than edges, cells out of
+    # the level count as walls. Returns (n, 4) x1, y1, x2, y2 in pixels from edges start
+    occluders = []
+    # cells in front of the faces are one row or column before or after them
+    for side, front in ((TOP_SIDE, -1), (BOTTOM_SIDE, 1), (LEFT_SIDE, -1), (RIGHT_SIDE, 1)):
+        faces, walls = (edges >> side & 1).astype(bool), solid
+        if side in (LEFT_SIDE, RIGHT_SIDE):
+            faces, walls = faces.T, solid.T
+        steps = np.diff(np.pad(faces, ((0, 0), (1, 1))).astype(np.int8), axis=1)
+        # runs of faces in a row (column for left and right) are [start, end) cells
+        lines, starts = np.nonzero(steps == 1)
+        ends = np.nonzero(steps == -1)[1]
+        turn_start = walls[lines + 1, starts] & walls[lines + 1 + front, starts]
+        turn_end = walls[lines + 1, ends + 1] & walls[lines + 1 + front, ends + 1]
+        run_start = starts * BLOCK_SIZE + np.where(turn_start, -depth, depth)
+        run_end = ends * BLOCK_SIZE + np.where(turn_end, depth, -depth)
+        across = (lines + (front > 0)) * BLOCK_SIZE - front * depth
+        run = np.stack((run_start, across, run_end, across), axis=1)[run_end > run_start]
+        occluders.append(run[:, [1, 0, 3, 2]] if side in (LEFT_SIDE, RIGHT_SIDE) else run)
+    return np.concatenate(occluders).astype(float)
+
+
+def compute_pvs(cells: np.ndarray, region_size=PVS_REGION_SIZE, depth=PVS_OCCLUDER_DEPTH, bins=PVS_ANGLE_BINS):
+    # potentially visible cells of every region_size x region_size region of the level, conservative for
+    # positions at least MIN_RENDER_DISTANCE away from walls (player collision keeps it farther).
+    # Visibility is found from sample points of the region with wall occluders moved depth pixels into walls
+    # (see wall_occluders): if a segment from a sample point is blocked by them, segments from all points
+    # closer than depth to the sample point are blocked by walls, so sample points depth * sqrt(2) apart
+    # cover the region. From a sample point every angle bin gets the distance after which all its rays
+    # are blocked by one occluder, a cell is hidden if it is farther than that in all bins it touches.
+    # Cells farther than render distance from the region are hidden too. Returns (regions height,
+    # regions width, packed bits) array, bits are window x window cells starting reach cells up and left of
+    # the region, see pvs_window
+    height, width = cells.shape
+    reach, window = pvs_window(region_size)
+    edges = find_wall_edges(cells)
+    open_cells = (cells != CELL_WALL) & (cells != CELL_NONE)
+    solid = np.pad(cells == CELL_WALL, reach + 1, constant_values=True)
+    padded_edges = np.pad(edges, reach)
+    bin_size = 2 * pi / bins
+    # cells span less than half a turn of bins
+    levels = bins.bit_length()
+
+    # sample points relative to the window start are the same for every region
+    samples_per_side = ceil(region_size * BLOCK_SIZE / (depth * sqrt(2)))
+    spacing = region_size * BLOCK_SIZE / samples_per_side
+    sample_offsets = (np.arange(samples_per_side) + 0.5) * spacing
+    sample_x, sample_y = np.meshgrid(sample_offsets, sample_offsets)
+    sample_x, sample_y = sample_x.ravel(), sample_y.ravel()
+    # nearest distance and bins touched by every window cell from every sample point
+    corners = np.arange(window) * BLOCK_SIZE
+    to_x = np.stack([np.tile(corners + dx, window) for dx in (0, BLOCK_SIZE, 0, BLOCK_SIZE)])
+    to_y = np.stack([np.repeat(corners + dy, window) for dy in (0, 0, BLOCK_SIZE, BLOCK_SIZE)])
+    to_x = to_x - (reach * BLOCK_SIZE + sample_x[:, None, None])
+    to_y = to_y - (reach * BLOCK_SIZE + sample_y[:, None, None])
+    center = np.arctan2(to_y.mean(axis=1), to_x.mean(axis=1))
+    relative = (np.arctan2(to_y, to_x) - center[:, None] + pi) % (2 * pi) - pi
+    cell_start = (center + relative.min(axis=1)) % (2 * pi)
+    cell_first = np.floor(cell_start / bin_size).astype(np.int64)
+    cell_last = np.floor((cell_start + relative.max(axis=1) - relative.min(axis=1)) / bin_size).astype(np.int64)
+    cell_level = np.log2(cell_last - cell_first + 1).astype(np.int64)
+    cell_second = cell_last - (1 << cell_level) + 1
+    cell_distance = np.hypot(np.maximum(0, np.maximum(to_x[:, 0], -to_x[:, 3])),
+                             np.maximum(0, np.maximum(to_y[:, 0], -to_y[:, 3])))
+
+    regions_y, regions_x = -(-height // region_size), -(-width // region_size)
+    bits = np.zeros((regions_y, regions_x, -(-window * window // 8)), dtype=np.uint8)
+    for region_y in range(regions_y):
+        for region_x in range(regions_x):
+            cell_y, cell_x = region_y * region_size, region_x * region_size
+            if not open_cells[cell_y:cell_y + region_size, cell_x:cell_x + region_size].any():
+                continue
+            left, top = cell_x * BLOCK_SIZE, cell_y * BLOCK_SIZE
+            right = min(cell_x + region_size, width) * BLOCK_SIZE
+            bottom = min(cell_y + region_size, height) * BLOCK_SIZE
+            window_x = cell_x - reach + np.arange(window)
+            window_y = cell_y - reach + np.arange(window)
+
+            # cells of the level in render distance of the region
+            gap_x = np.maximum(0, np.maximum(left - (window_x + 1) * BLOCK_SIZE, window_x * BLOCK_SIZE - right))
+            gap_y = np.maximum(0, np.maximum(top - (window_y + 1) * BLOCK_SIZE, window_y * BLOCK_SIZE - bottom))
+            visible = np.hypot(gap_y[:, None], gap_x[None, :]) <= MAX_RENDER_DISTANCE
+            visible &= ((window_y >= 0) & (window_y < height))[:, None] & ((window_x >= 0) & (window_x < width))
+            visible = visible.ravel()
+            targets = np.flatnonzero(visible)
+
+            # sample points whose squares have some open cell, the other ones are never needed
+            near_open = np.zeros(len(sample_x), dtype=bool)
+            for dx in (-spacing / 2, spacing / 2):
+                for dy in (-spacing / 2, spacing / 2):
+                    x = np.minimum((left + sample_x + dx) // BLOCK_SIZE, width - 1).astype(np.int64)
+                    y = np.minimum((top + sample_y + dy) // BLOCK_SIZE, height - 1).astype(np.int64)
+                    near_open |= open_cells[y, x]
+            samples = np.flatnonzero(near_open)[:, None]
+            to_sample_x = reach * BLOCK_SIZE + sample_x[samples, None]
+            to_sample_y = reach * BLOCK_SIZE + sample_y[samples, None]
+
+            # occluders in the window relative to its start, segments between the region and window cells
+            # don't leave it. They are split into pieces two depths long overlapping by one, a bin is blocked
+            # after the farthest end of a piece covering it, near the real distance
+            occluders = wall_occluders(
+                solid[cell_y:cell_y + window + 2, cell_x:cell_x + window + 2],
+                padded_edges[cell_y:cell_y + window, cell_x:cell_x + window], depth)
+            length = np.abs(occluders[:, 2:] - occluders[:, :2]).sum(axis=1)
+            pieces = np.maximum(1, np.ceil(length / depth).astype(np.int64) - 1)
+            piece = np.arange(pieces.sum()) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+            occluders, length = np.repeat(occluders, pieces, axis=0), np.repeat(length, pieces)
+            direction = (occluders[:, 2:] - occluders[:, :2]) / length[:, None]
+            ends = np.stack((piece * depth, np.minimum((piece + 2) * depth, length)), axis=1)
+            x1, x2 = np.moveaxis(occluders[:, 0, None] + direction[:, 0, None] * ends - to_sample_x, 2, 0)
+            y1, y2 = np.moveaxis(occluders[:, 1, None] + direction[:, 1, None] * ends - to_sample_y, 2, 0)
+            start = np.arctan2(y1, x1) % (2 * pi)
+            span = (np.arctan2(y2, x2) - start) % (2 * pi)
+            # angles from the first end to the second one or the other way round
+            start = np.where(span > pi, start + span - 2 * pi, start) % (2 * pi)
+            span = np.where(span > pi, 2 * pi - span, span)
+            # sample point on the occluder line sees it as a line or a point
+            span[x1 * y2 - y1 * x2 == 0] = 0
+            first = np.ceil(start / bin_size).astype(np.int64)
+            last = np.floor((start + span) / bin_size).astype(np.int64)
+            # every bin fully covered by a piece is blocked after it
+            count = np.maximum(last - first, 0).ravel()
+            entry = np.repeat(np.arange(count.size), count)
+            covered = np.arange(len(entry)) - (np.cumsum(count) - count)[entry]
+            covered = (first.ravel()[entry] + covered) % bins + entry // first.shape[1] * bins
+            blocked = np.full(len(samples) * bins, np.inf)
+            np.minimum.at(blocked, covered, np.maximum(np.hypot(x1, y1), np.hypot(x2, y2)).ravel()[entry])
+            # sparse table of maximums of 2 ** level bins from every bin, over two turns so intervals through
+            # angle 0 need no splitting
+            blocked = blocked.reshape(len(samples), bins)
+            table = [np.concatenate((blocked, blocked), axis=1)]
+            for level in range(1, levels):
+                table.append(np.maximum(table[-1], np.roll(table[-1], -(1 << (level - 1)), axis=1)))
+            table = np.stack(table)
+
+            # a cell is hidden if it is hidden from all sample points
+            level = cell_level[samples, targets]
+            rows = np.arange(len(samples))[:, None]
+            farthest_block = np.maximum(table[level, rows, cell_first[samples, targets]],
+                                        table[level, rows, cell_second[samples, targets]])
+            visible[targets] = ~(farthest_block < cell_distance[samples, targets]).all(axis=0)
+            bits[region_y, region_x] = np.packbits(visible)
+    return bits
+
+
+def pvs_window(region_size: int):
+    # cells around a region that can be in render distance from it and side of the square window of cells
+    # whose visibility is stored for the region
+    reach = MAX_RENDER_DISTANCE // BLOCK_SIZE + 1
+    return reach, region_size + 2 * reach
+
+
+def level_source_hash(path: str):
+    with open(path, "rb") as file:
+        source = file.read()
+    # minimap depends on these too
+    settings = f"{LEVEL_FORMAT_VERSION} {MINIMAP_BLOCK_SIZE} {CELL_MINIMAP_COLORS}".encode()
+    return hashlib.sha256(settings + source).hexdigest()
+
+
+def compiled_level_path(path: str):
+    return os.path.join(os.path.dirname(path), LEVEL_CACHE_DIR, os.path.basename(path) + ".bin")
+
+
+def compile_level(path: str, out_path: str = None, pvs=False):
+    # level file -> binary artifact with cells, wall edges, spawn lists, minimap if level is not too big
+    # and potentially visible sets if pvs
+    with open(path, "r") as file:
+        level_data = [i.rstrip() for i in file.readlines()]
+    cells = parse_level(level_data)
+    arrays = {
+        "cells": cells,
+        "row_lengths": np.array([len(row) for row in level_data], dtype=np.int32),
+        "edges": find_wall_edges(cells),
+        "player_spawns": np.argwhere(cells == CELL_PLAYER_SPAWN)[:, ::-1].astype(np.int32),
+        "enemy_spawns": np.argwhere(cells == CELL_ENEMY_SPAWN)[:, ::-1].astype(np.int32),
+    }
+    if cells.size <= MINIMAP_MAX_CELLS:
+        arrays["minimap"] = render_minimap(cells, len(level_data[0]))
+    if pvs:
+        arrays["pvs"] = compute_pvs(cells)
+        arrays["pvs_region_size"] = np.array(PVS_REGION_SIZE, dtype=np.int32)
+
+    if out_path is None:
+        out_path = compiled_level_path(path)
+    header = {"version": LEVEL_FORMAT_VERSION, "source_hash": level_source_hash(path), "arrays": {}}
+    offset = 0
+    for name, array in arrays.items():
+        header["arrays"][name] = (array.dtype.str, array.shape, offset)
+        offset = align(offset + array.nbytes)
+    header_bytes = json.dumps(header).encode()
+
+    out_dir = os.path.dirname(out_path) or "."
+    os.makedirs(out_dir, exist_ok=True)
+    # unique temporary file in the same directory, processes compiling the same level don't write over
+    # each other and the replace stays on one file system
+    with tempfile.NamedTemporaryFile("wb", dir=out_dir, prefix=os.path.basename(out_path), suffix=".tmp",
+                                     delete=False) as file:
+        file.write(LEVEL_MAGIC)
+        file.write(len(header_bytes).to_bytes(4, "little"))
+        file.write(header_bytes)
+        data_start = align(file.tell())
+        for name, array in arrays.items():
+            file.seek(data_start + header["arrays"][name][2])
+            file.write(np.ascontiguousarray(array).tobytes())
+        file.truncate(data_start + offset)
+    os.replace(file.name, out_path)
+    return out_path
+
+
+def align(offset: int, alignment=16):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def read_compiled_level(path: str):
+    # header and memory-mapped arrays of compiled level
+    with open(path, "rb") as file:
+        if file.read(len(LEVEL_MAGIC)) != LEVEL_MAGIC:
+            raise IOError(f"{path} is not a compiled level")
+        header_length = int.from_bytes(file.read(4), "little")
+        header = json.loads(file.read(header_length))
+    data_start = align(len(LEVEL_MAGIC) + 4 + header_length)
+    buffer = np.memmap(path, dtype=np.uint8, mode="r")
+    arrays = {}
+    for name, (dtype, shape, offset) in header["arrays"].items():
+        dtype = np.dtype(dtype)
+        start = data_start + offset
+        arrays[name] = buffer[start:start + dtype.itemsize * int(np.prod(shape))].view(dtype).reshape(shape)
+    return header, arrays
+
+
+def load_compiled_level(path: str):
+    # compiled level arrays, level is compiled again (without pvs) if its source has changed
+    compiled_path = compiled_level_path(path)
+    if os.path.exists(compiled_path):
+        header, arrays = read_compiled_level(compiled_path)
+        if header["version"] == LEVEL_FORMAT_VERSION and header["source_hash"] == level_source_hash(path):
+            return arrays
+        # the old artifact stays mapped while arrays are alive and then can't be replaced on Windows
+        del header, arrays
+    compile_level(path, compiled_path)
+    return read_compiled_level(compiled_path)[1]
+
+
+def load_pvs(path: str):
+    # potentially visible set stored with compiled level, it is not computed here as it takes long on big levels
+    level = load_compiled_level(path)
+    if "pvs" not in level:
+        raise IOError(f"{path} has no compiled potentially visible set, compile it with compile_levels.py --pvs")
+    return PotentiallyVisibleSet(np.asarray(level["pvs"]), int(level["pvs_region_size"]), level["cells"].shape)
+
+
+def wall_neighbours(edges: int):
+    return tuple(bool(edges >> side & 1) for side in (LEFT_SIDE, TOP_SIDE, RIGHT_SIDE, BOTTOM_SIDE))
+
+
+class FloorCellType:
+    # behaviour of floor and spawn cells
+    def check_collision(self, obj, x: int, y: int, edges: int):
+        pass
 
-def load_level(screen:pygame.Surface, path: str):
+
+class WallCellType:
+    # behaviour of wall cells, the same as Wall.check_collision, edges are exposed sides bits of the cell
+    def check_collision(self, obj, x: int, y: int, edges: int):
+        for collision in WALL_COLLISIONS[edges]:
+            collision(x * BLOCK_SIZE, y * BLOCK_SIZE, obj)
+
+
+# one behaviour object per cell type, shared by all cells of the type
+FLOOR_CELL_TYPE = FloorCellType()
+CELL_TYPES = {CELL_FLOOR: FLOOR_CELL_TYPE, CELL_WALL: WallCellType(), CELL_PLAYER_SPAWN: FLOOR_CELL_TYPE,
+              CELL_ENEMY_SPAWN: FLOOR_CELL_TYPE, CELL_NONE: FLOOR_CELL_TYPE}
+
+
+class CellGridRow:
+    # level_map[y] of CellGrid
+    def __init__(self, grid: "CellGrid", y: int):
+        self.grid = grid
+        self.y = y
+
+    def __len__(self):
+        return self.grid.row_lengths[self.y]
+
+    def __getitem__(self, x: int):
+        return self.grid.block(x, self.y)
+
+
+class CellGrid:
+    def __init__(self, level: dict, wall_texture: pygame.Surface):
+        # cell types and exposed wall sides of compiled level in parallel arrays, one byte each per cell,
+        # collision goes by cell type behaviour (CELL_TYPES), Wall objects are built only when they are asked for
+        # can be used as level map: level[y][x] and len(level) work as with lists of blocks
+        self.cells = level["cells"]
+        self.edges = level["edges"]
+        self.width = self.cells.shape[1]
+        self.row_lengths = level["row_lengths"].tolist()
+        # flat views of the arrays, indexing them gives python ints
+        self.cell_types = memoryview(np.ascontiguousarray(self.cells)).cast("B")
+        self.edge_bits = memoryview(np.ascontiguousarray(self.edges)).cast("B")
+        self.behaviours = [CELL_TYPES.get(cell_type, FLOOR_CELL_TYPE) for cell_type in range(256)]
+        self.wall_texture = wall_texture
+        self.walls = {}
+        # floor blocks have no state, one is shared by all not wall cells
+        self.floor_block = FloorBlock()
+
+    def __len__(self):
+        return len(self.row_lengths)
+
+    def __getitem__(self, y: int):
+        if not 0 <= y < len(self.row_lengths):
+            raise IndexError(y)
+        return CellGridRow(self, y)
+
+    def block(self, x: int, y: int):
+        if not (0 <= y < len(self.row_lengths) and 0 <= x < self.row_lengths[y]):
+            raise IndexError((x, y))
+        if self.cell_types[y * self.width + x] == CELL_WALL:
+            return self.wall(x, y)
+        return self.floor_block
+
+    def wall(self, x: int, y: int):
+        # walls are kept by flat cell index
+        wall = self.walls.get(y * self.width + x)
+        if wall is None:
+            wall = self.build_wall(x, y)
+            self.walls[y * self.width + x] = wall
+        return wall
+
+    def build_wall(self, x: int, y: int):
+        pos = pygame.Vector2(x * BLOCK_SIZE + BLOCK_SIZE // 2, y * BLOCK_SIZE + BLOCK_SIZE // 2)
+        return Wall(pos, "#", wall_neighbours(self.edge_bits[y * self.width + x]), self.wall_texture)
+
+    def all_walls(self):
+        # walls in rows order, as they go in level file
+        return [self.wall(x, y) for y, x in np.argwhere(self.cells == CELL_WALL).tolist()]
+
+    def check_collision(self, obj: EntityBasicClass):
+        # EntityBasicClass.check_collision without block objects: the same neighbours in the same order
+        x, y = obj.cur_block()
+        if 0 < x < self.row_lengths[0] - 1 and 0 < y < len(self.row_lengths) - 1:
+            for dx, dy in ((-1, -1), (1, 1), (-1, 1), (1, -1), (-1, 0), (0, -1), (1, 0), (0, 1)):
+                i = (y + dy) * self.width + x + dx
+                self.behaviours[self.cell_types[i]].check_collision(obj, x + dx, y + dy, self.edge_bits[i])
+
+    def solid_grid(self):
+        # build_solid_grid without building walls
+        return self.cells == CELL_WALL
+
+
+class LevelChunk:
+    def __init__(self, walls: dict):
+        # flat cell index (y * level width + x) -> wall of the chunk
+        self.walls = walls
+
+
+class LevelChunks(CellGrid):
+    def __init__(self, level: dict, wall_texture: pygame.Surface, chunk_size=LEVEL_CHUNK_SIZE,
+                 max_chunks=LEVEL_MAX_CHUNKS):
+        # CellGrid whose walls are built by chunks when they are first used,
+        # least recently used chunks are dropped when there are more than max_chunks of them
+        # compiled level arrays stay memory-mapped
+        super().__init__(level, wall_texture)
+        self.chunk_size = chunk_size
+        self.max_chunks = max_chunks
+        self.chunks = OrderedDict()
+        self.built = 0
+        # walls are looked up from compositor worker threads too
+        self.lock = Lock()
+
+    def chunk(self, chunk_x: int, chunk_y: int):
+        key = (chunk_x, chunk_y)
+        with self.lock:
+            chunk = self.chunks.get(key)
+            if chunk is None:
+                chunk = self.build_chunk(chunk_x, chunk_y)
+                self.chunks[key] = chunk
+                if len(self.chunks) > self.max_chunks:
+                    self.chunks.popitem(last=False)
+            else:
+                self.chunks.move_to_end(key)
+            return chunk
+
+    def build_chunk(self, chunk_x: int, chunk_y: int):
+        start_x, start_y = chunk_x * self.chunk_size, chunk_y * self.chunk_size
+        cells = self.cells[start_y:start_y + self.chunk_size, start_x:start_x + self.chunk_size]
+        walls = {}
+        for y, x in (np.argwhere(cells == CELL_WALL) + (start_y, start_x)).tolist():
+            walls[y * self.width + x] = self.build_wall(x, y)
+        self.built += 1
+        return LevelChunk(walls)
+
+    def wall(self, x: int, y: int):
+        return self.chunk(x // self.chunk_size, y // self.chunk_size).walls[y * self.width + x]
+
+    def walls_near(self, pos: pygame.Vector2, radius=MAX_RENDER_DISTANCE):
+        # walls of chunks in square around pos, for scan casting
+        chunk_length = self.chunk_size * BLOCK_SIZE
+        chunks_y = (len(self.row_lengths) - 1) // self.chunk_size
+        chunks_x = (self.width - 1) // self.chunk_size
+        walls = []
+        for chunk_y in range(max(0, int((pos.y - radius) // chunk_length)),
+                             min(chunks_y, int((pos.y + radius) // chunk_length)) + 1):
+            for chunk_x in range(max(0, int((pos.x - radius) // chunk_length)),
+                                 min(chunks_x, int((pos.x + radius) // chunk_length)) + 1):
+                walls.extend(self.chunk(chunk_x, chunk_y).walls.values())
+        return walls
+
+
+def spawn_level_entities(level: dict, store: EntityStore = None):
+    # player and enemies from spawn lists of compiled level, enemies are put into store if it is given
     now = 0
+    pelmen_king_frames = assets.animation("textures/pelmen_king", 12)
+    if not len(level["player_spawns"]):
+        raise IOError("No player block found")
 
-    stone_wall_1_texture = pygame.image.load("./textures/stone_wall_1.jpg").convert()
-    pelmen_king_frames = []
-    for i in range(12):
-        frame = pygame.image.load(f"./textures/pelmen_king/{i}.png").convert_alpha()
-        pelmen_king_frames.append(frame)
+    def spawn_pos(x: int, y: int):
+        return pygame.Vector2(x * BLOCK_SIZE + BLOCK_SIZE // 2, y * BLOCK_SIZE + BLOCK_SIZE // 2)
 
+    # the last player spawn in rows order is used
+    player = SpawnBlockPlayer(spawn_pos(*level["player_spawns"][-1].tolist())).spawn_entity()
+    player.weapons.append(LaserGun(player, now))
+    entities = []
+    for x, y in level["enemy_spawns"].tolist():
+        block = SpawnBlockEnemy(spawn_pos(x, y), pelmen_king_frames, PLAYER_SPEED * 2, chasing)
+        entity = block.spawn_entity(now, store)
+        entity.weapon = PelmenLaserGun(entity, now)
+        entities.append(entity)
+    return player, entities
 
-    file = open(path, "r")
 
-    level_data = [i.rstrip() for i in file.readlines()]
+def load_level(screen:pygame.Surface, path: str, store: EntityStore = None):
+    # level map is CellGrid, its Wall objects are built only when they are asked for (all_walls for walls list)
+    # enemies are put into store if it is given
+    stone_wall_1_texture = assets.image("textures/stone_wall_1.jpg")
+    # build wall columns once at level load
+    get_texture_columns(stone_wall_1_texture)
 
-    # process level data
-    level_objs_map = []
-    walls = []
-    entities = []
-    player = None
+    level = load_compiled_level(path)
+    player, entities = spawn_level_entities(level, store)
+    level_objs_map = CellGrid(level, stone_wall_1_texture)
+    minimap = pygame.surfarray.make_surface(level["minimap"]).convert() if "minimap" in level else None
 
-    minimap = pygame.Surface((len(level_data[0]) * MINIMAP_BLOCK_SIZE, len(level_data) * MINIMAP_BLOCK_SIZE)).convert()
+    return player, level_objs_map, entities, minimap
 
-    for y in range(len(level_data)):
-        level_objs_map.append([])
-        for x in range(len(level_data[y])):
-            pos = pygame.Vector2(x * BLOCK_SIZE + BLOCK_SIZE // 2, y * BLOCK_SIZE + BLOCK_SIZE // 2)
-            left_b = x * MINIMAP_BLOCK_SIZE
-            top_b = y * MINIMAP_BLOCK_SIZE
-            minimap_block = pygame.Rect(left_b, top_b, MINIMAP_BLOCK_SIZE, MINIMAP_BLOCK_SIZE)
-            match level_data[y][x]:
-                case "@":
-                    block = SpawnBlockPlayer(pos)
-                    player = block.spawn_entity()
-                    player.weapons.append(LaserGun(player, now))
-
-                    level_objs_map[y].append(block)
-
-                    minimap_block_color = SPAWN_POINT_COLOR
-                case "#":
-                    block = init_wall(level_data, "#", pos, stone_wall_1_texture, x, y)
-
-                    walls.append(block)
-                    level_objs_map[y].append(block)
-
-                    minimap_block_color = HASH_COLOR
-
-                case "!":
-                    block = SpawnBlockEnemy(pos, pelmen_king_frames, PLAYER_SPEED * 2, chasing)
-                    entity = block.spawn_entity(now)
-                    entity.weapon = PelmenLaserGun(entity, now)
-                    entities.append(entity)
-                    level_objs_map[y].append(block)
-
-                    minimap_block_color = ENTITY_1_SPAWN_POINT_COLOR
-                case _:
-                    block = FloorBlock()
-                    level_objs_map[y].append(block)
-
-                    minimap_block_color = FLOOR_COLOR
-
-            pygame.draw.rect(minimap, minimap_block_color, minimap_block)
-    if player is None:
-        raise IOError("No player block found")
 
-    return player, level_objs_map, walls, entities, minimap
+def load_level_chunks(screen: pygame.Surface, path: str, store: EntityStore = None, chunk_size=LEVEL_CHUNK_SIZE,
+                      max_chunks=LEVEL_MAX_CHUNKS):
+    # load_level for big levels, level map is LevelChunks, walls are taken with its walls_near
+    stone_wall_1_texture = assets.image("textures/stone_wall_1.jpg")
+    get_texture_columns(stone_wall_1_texture)
+
+    level = load_compiled_level(path)
+    player, entities = spawn_level_entities(level, store)
+    level_chunks = LevelChunks(level, stone_wall_1_texture, chunk_size, max_chunks)
+    minimap = pygame.surfarray.make_surface(level["minimap"]).convert() if "minimap" in level else None
+
+    return player, level_chunks, entities, minimap
 
 def draw_minimap(screen:pygame.Surface, minimap:pygame.Surface, player:Player):
-    screen.blit(minimap, (0, 0))
+    # levels too big for minimap have only player marker
+    if minimap is not None:
+        screen.blit(minimap, (0, 0))
     looking_ang = -((player.look_ang * 180 / pi) % 360)
     fov = player.fov * 90 / pi
     start_ang = int(looking_ang - fov)
@@ -422,30 +1509,133 @@ def draw_minimap(screen:pygame.Surface, minimap:pygame.Surface, player:Player):
     gfxdraw.pie(screen, int(player.pos.x * MINIMAP_SCALE), int(player.pos.y * MINIMAP_SCALE), int(MINIMAP_BLOCK_SIZE * 1.5), start_ang, end_ang, pygame.Color("green"))
     pygame.draw.circle(screen, "yellow", player.pos * MINIMAP_SCALE, MINIMAP_BLOCK_SIZE / 2)
 
-def chasing(entity: Enemy, player: Player, projectiles: list, dt: int, now: int):
-    chase_distance = 150
-    shoot_distance = 350
+class FlowField:
+    def __init__(self, level_map: list, radius=FLOW_FIELD_RADIUS):
+        # shortest paths to player cell for every cell in window of radius cells around it, shared by all enemies,
+        # computed again only when player goes to another cell
+        # next_pos holds center of the next path cell for every window cell, nan if there is no path
+        self.solid = build_solid_grid(level_map)
+        self.radius = radius
+        self.origin = None
+        self.start_x = 0
+        self.start_y = 0
+        self.next_pos = np.full((0, 0, 2), np.nan)
+        self.updates = 0
+
+    def update(self, player_pos: pygame.Vector2):
+        cell = (int(player_pos.x // BLOCK_SIZE), int(player_pos.y // BLOCK_SIZE))
+        if cell == self.origin:
+            return
+        self.origin = cell
+        self.updates += 1
+        height, width = self.solid.shape
+        self.start_x, self.start_y = max(0, cell[0] - self.radius), max(0, cell[1] - self.radius)
+        end_x, end_y = min(width, cell[0] + self.radius + 1), min(height, cell[1] + self.radius + 1)
+        solid = self.solid[self.start_y:end_y, self.start_x:end_x].tolist()
+        window_height, window_width = len(solid), len(solid[0]) if solid else 0
+        next_pos = [[(np.nan, np.nan)] * window_width for _ in range(window_height)]
+        origin_x, origin_y = cell[0] - self.start_x, cell[1] - self.start_y
+        if not (0 <= origin_x < window_width and 0 <= origin_y < window_height) or solid[origin_y][origin_x]:
+            self.next_pos = np.array(next_pos, dtype=float).reshape(window_height, window_width, 2)
+            return
+
+        # dijkstra from player cell, enemy in a reached cell goes to the cell it was reached from,
+        # diagonal steps are not taken past wall corners
+        dist = [[None] * window_width for _ in range(window_height)]
+        dist[origin_y][origin_x] = 0
+        heap = [(0, origin_x, origin_y)]
+        while heap:
+            cur_dist, x, y = heappop(heap)
+            if cur_dist > dist[y][x]:
+                continue
+            center = ((self.start_x + x) * BLOCK_SIZE + BLOCK_SIZE / 2,
+                      (self.start_y + y) * BLOCK_SIZE + BLOCK_SIZE / 2)
+            for dx, dy, cost in FLOW_FIELD_STEPS:
+                nx, ny = x + dx, y + dy
+                if not (0 <= nx < window_width and 0 <= ny < window_height) or solid[ny][nx]:
+                    continue
+                if dx and dy and (solid[y][nx] or solid[ny][x]):
+                    continue
+                if dist[ny][nx] is None or cur_dist + cost < dist[ny][nx]:
+                    dist[ny][nx] = cur_dist + cost
+                    next_pos[ny][nx] = center
+                    heappush(heap, (cur_dist + cost, nx, ny))
+        self.next_pos = np.array(next_pos, dtype=float).reshape(window_height, window_width, 2)
+
+    def target(self, pos: pygame.Vector2, player_pos: pygame.Vector2):
+        # point to go to from pos: next path cell center, player itself if pos is in its cell or has no path
+        self.update(player_pos)
+        x, y = int(pos.x // BLOCK_SIZE) - self.start_x, int(pos.y // BLOCK_SIZE) - self.start_y
+        if 0 <= y < self.next_pos.shape[0] and 0 <= x < self.next_pos.shape[1]:
+            target_x, target_y = self.next_pos[y, x].tolist()
+            if target_x == target_x:
+                return pygame.Vector2(target_x, target_y)
+        return pygame.Vector2(player_pos)
+
+    def targets(self, positions: np.ndarray, player_pos: pygame.Vector2):
+        # target for every row of positions (n, 2)
+        self.update(player_pos)
+        targets = np.tile((player_pos.x, player_pos.y), (len(positions), 1))
+        x = (positions[:, 0] // BLOCK_SIZE).astype(np.int64) - self.start_x
+        y = (positions[:, 1] // BLOCK_SIZE).astype(np.int64) - self.start_y
+        inside = (x >= 0) & (x < self.next_pos.shape[1]) & (y >= 0) & (y < self.next_pos.shape[0])
+        path = self.next_pos[y[inside], x[inside]]
+        has_path = ~np.isnan(path[:, 0])
+        targets[np.flatnonzero(inside)[has_path]] = path[has_path]
+        return targets
+
+
+def chasing(entity: Enemy, player: Player, projectiles: list, dt: int, now: int, flow_field: FlowField = None):
+    # goes straight to player if there is no flow field
     cur_distance = distance(player.pos, entity.pos)
 
-    if shoot_distance >= cur_distance > chase_distance:
-        proj = entity.weapon.use(now, player)
-        if proj:
-            projectiles.append(proj)
+    if SHOOT_DISTANCE >= cur_distance > CHASE_DISTANCE:
+        entity.weapon.use(now, player, projectiles)
 
-    elif chase_distance >= cur_distance > 40:
-        vel = (player.pos - entity.pos).normalize() * entity.speed * dt
+    elif CHASE_DISTANCE >= cur_distance > KEEP_DISTANCE:
+        target = player.pos if flow_field is None else flow_field.target(entity.pos, player.pos)
+        vel = (target - entity.pos).normalize() * entity.speed * dt
         entity.vel = vel
 
-    elif cur_distance < 40:
+    elif cur_distance < KEEP_DISTANCE:
         vel = -(player.pos - entity.pos).normalize() * entity.speed * dt
         entity.vel = vel
 
+def chasing_batch(store: EntityStore, slots: np.ndarray, player: Player, projectiles: list, dt: int, now: int,
+                  flow_field: FlowField = None):
+    # chasing for all store slots at once
+    if not len(slots):
+        return
+    delta = np.array((player.pos.x, player.pos.y)) - store.pos[slots]
+    cur_distance = np.hypot(delta[:, 0], delta[:, 1])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        direction = delta / cur_distance[:, None]
+    speed = store.speed[slots] * dt
+
+    chase = (CHASE_DISTANCE >= cur_distance) & (cur_distance > KEEP_DISTANCE)
+    keep = (cur_distance < KEEP_DISTANCE) & (cur_distance > 0)
+    vel = store.vel[slots]
+    if flow_field is not None and chase.any():
+        chase_delta = flow_field.targets(store.pos[slots[chase]], player.pos) - store.pos[slots[chase]]
+        vel[chase] = chase_delta / np.hypot(chase_delta[:, 0], chase_delta[:, 1])[:, None] * speed[chase, None]
+    else:
+        vel[chase] = direction[chase] * speed[chase, None]
+    vel[keep] = -direction[keep] * speed[keep, None]
+    store.vel[slots] = vel
+
+    # only enemies with ready weapon shoot
+    ready = (SHOOT_DISTANCE >= cur_distance) & (cur_distance > CHASE_DISTANCE)
+    ready &= now - store.weapon_time[slots] >= store.weapon_speed[slots]
+    for slot in slots[ready].tolist():
+        store.entities[slot].weapon.use(now, player, projectiles)
+
 # def standing_shooting(entity: EntityBasicClass, player: Player, projectiles: list, dt: int):
 #     if 250 > distance(player.pos, entity.pos) > 40:
 
 
-def init_enemy(pos: pygame.Vector2, frames: list[pygame.Surface], speed: int, ai, now: int):
-    entity = Enemy(pos, speed, frames, ai, now)
+def init_enemy(pos: pygame.Vector2, frames: list[pygame.Surface], speed: int, ai, now: int,
+               store: EntityStore = None):
+    entity = Enemy(pos, speed, frames, ai, now, store)
     return entity
 
 def is_player_dead(player: Player):
@@ -453,36 +1643,257 @@ def is_player_dead(player: Player):
         return True
     else:
         return False
-def process_projectiles(projs: list[Projectile], entities: list[EntityBasicClass], player: Player, dt: int, now: int):
+class SpatialHash:
+    def __init__(self, entities=(), cell_size=BLOCK_SIZE):
+        self.cell_size = cell_size
+        # cell -> entities with center in it
+        self.cells = {}
+        # entity -> its cell
+        self.entity_cells = {}
+        for entity in entities:
+            self.insert(entity)
+
+    def cell_of(self, pos: pygame.Vector2):
+        return int(pos.x // self.cell_size), int(pos.y // self.cell_size)
+
+    def insert(self, entity: EntityBasicClass):
+        cell = self.cell_of(entity.pos)
+        self.cells.setdefault(cell, set()).add(entity)
+        self.entity_cells[entity] = cell
+
+    def remove(self, entity: EntityBasicClass):
+        cell = self.entity_cells.pop(entity, None)
+        if cell is not None:
+            bucket = self.cells[cell]
+            bucket.discard(entity)
+            if not bucket:
+                del self.cells[cell]
+
+    def update(self, entity: EntityBasicClass):
+        # moves entity to another cell only if it left its cell
+        cell = self.cell_of(entity.pos)
+        old_cell = self.entity_cells.get(entity)
+        if cell != old_cell:
+            if old_cell is not None:
+                self.remove(entity)
+            self.cells.setdefault(cell, set()).add(entity)
+            self.entity_cells[entity] = cell
+
+    def query(self, pos: pygame.Vector2, radius: float):
+        # entities closer than radius to pos
+        min_x, min_y = self.cell_of(pygame.Vector2(pos.x - radius, pos.y - radius))
+        max_x, max_y = self.cell_of(pygame.Vector2(pos.x + radius, pos.y + radius))
+        found = []
+        for y in range(min_y, max_y + 1):
+            for x in range(min_x, max_x + 1):
+                for entity in self.cells.get((x, y), ()):
+                    if (entity.pos.x - pos.x) ** 2 + (entity.pos.y - pos.y) ** 2 < radius ** 2:
+                        found.append(entity)
+        return found
+
+
+# sides pairs of diagonal neighbours checked by CollisionGrid
+RIGHT_BOTTOM_BITS = 1 << RIGHT_SIDE | 1 << BOTTOM_SIDE
+LEFT_BOTTOM_BITS = 1 << LEFT_SIDE | 1 << BOTTOM_SIDE
+RIGHT_TOP_BITS = 1 << RIGHT_SIDE | 1 << TOP_SIDE
+LEFT_TOP_BITS = 1 << LEFT_SIDE | 1 << TOP_SIDE
+
+
+class CollisionGrid:
+    def __init__(self, level_map: list, edges: np.ndarray = None):
+        # exposed sides of walls as bits (1 << side), the same sides that have collision closures in Wall
+        # edges of compiled level (see find_wall_edges) are taken from CellGrid or can be given
+        # instead of building them from level map
+        self.height = len(level_map)
+        self.width = len(level_map[0])
+        if edges is None and isinstance(level_map, CellGrid):
+            edges = level_map.edges
+        if edges is None:
+            edges = np.zeros((self.height, max(len(row) for row in level_map)), dtype=np.uint8)
+            for y in range(len(level_map)):
+                for x in range(len(level_map[y])):
+                    if isinstance(level_map[y][x], Wall):
+                        for side, edge in enumerate(level_map[y][x].edges):
+                            if edge:
+                                edges[y, x] |= 1 << side
+        # plain array, indexing memory-mapped one costs more per call
+        self.edges = np.asarray(edges)
+        self.flat_edges = self.edges.ravel()
+        stride = self.edges.shape[1]
+        # flat offsets of neighbours: left, right, top, bottom, top left, top right, bottom left, bottom right
+        self.neighbour_offsets = np.array((-1, 1, -stride, stride, -stride - 1, -stride + 1, stride - 1,
+                                           stride + 1))
+        self.stride = stride
+
+    def resolve_arrays(self, positions: np.ndarray, velocities: np.ndarray):
+        # Wall.check_collision of all 8 neighbours for every entity at once, velocities (n, 2) are changed in place
+        cell_x = (positions[:, 0] // BLOCK_SIZE).astype(np.int64)
+        cell_y = (positions[:, 1] // BLOCK_SIZE).astype(np.int64)
+        inside = (cell_x > 0) & (cell_x < self.width - 1) & (cell_y > 0) & (cell_y < self.height - 1)
+        # sides of neighbours, entities outside of the level have none
+        index = np.where(inside, cell_y * self.stride + cell_x, self.stride + 1)
+        neighbours = self.flat_edges[index[:, None] + self.neighbour_offsets]
+        neighbours[~inside] = 0
+        left, right, top, bottom, top_left, top_right, bottom_left, bottom_right = neighbours.T
+        # position inside of the cell
+        local_x = positions[:, 0] - cell_x * BLOCK_SIZE
+        local_y = positions[:, 1] - cell_y * BLOCK_SIZE
+        vel_x = velocities[:, 0]
+        vel_y = velocities[:, 1]
+
+        # walls next to the cell stop movement towards them
+        stop_x = ((left & 1 << RIGHT_SIDE).astype(bool) & (local_x <= PLAYER_COLLISION_SIZE) & (vel_x < 0)) | \
+                 ((right & 1 << LEFT_SIDE).astype(bool) & (local_x >= BLOCK_SIZE - PLAYER_COLLISION_SIZE) &
+                  (vel_x > 0))
+        stop_y = ((top & 1 << BOTTOM_SIDE).astype(bool) & (local_y <= PLAYER_COLLISION_SIZE) & (vel_y < 0)) | \
+                 ((bottom & 1 << TOP_SIDE).astype(bool) & (local_y >= BLOCK_SIZE - PLAYER_COLLISION_SIZE) &
+                  (vel_y > 0))
+        vel_x[stop_x] = 0
+        vel_y[stop_y] = 0
+
+        # corners of diagonal walls remove the part of velocity going into them
+        corner_left = (local_x > 0) & (local_x < PLAYER_COLLISION_SIZE)
+        corner_right = (local_x > BLOCK_SIZE - PLAYER_COLLISION_SIZE) & (local_x < BLOCK_SIZE)
+        corner_top = (local_y > 0) & (local_y < PLAYER_COLLISION_SIZE)
+        corner_bottom = (local_y > BLOCK_SIZE - PLAYER_COLLISION_SIZE) & (local_y < BLOCK_SIZE)
+        corners = (
+            (top_left, RIGHT_BOTTOM_BITS, corner_left & corner_top, -1, -1),
+            (top_right, LEFT_BOTTOM_BITS, corner_right & corner_top, 1, -1),
+            (bottom_left, RIGHT_TOP_BITS, corner_left & corner_bottom, -1, 1),
+            (bottom_right, LEFT_TOP_BITS, corner_right & corner_bottom, 1, 1),
+        )
+        for sides, bits, zone, dir_x, dir_y in corners:
+            corner = zone & ((sides & bits) == bits)
+            if not corner.any():
+                continue
+            dot = dir_x * vel_x + dir_y * vel_y
+            corner &= dot > 0
+            shift = np.where(corner, dot / 2, 0)
+            vel_x -= dir_x * shift
+            vel_y -= dir_y * shift
+        return velocities
+
+    def resolve(self, objs: list[EntityBasicClass]):
+        if not objs:
+            return
+        positions = np.array([(obj.pos.x, obj.pos.y) for obj in objs], dtype=float)
+        velocities = np.array([(obj.vel.x, obj.vel.y) for obj in objs], dtype=float)
+        self.resolve_arrays(positions, velocities)
+        for obj, vel in zip(objs, velocities.tolist()):
+            obj.vel = pygame.Vector2(vel)
+
+
+def process_projectiles(projs: list[Projectile], entities: list[EntityBasicClass], player: Player, dt: int, now: int,
+                        index: SpatialHash = None):
+    # with index only entities from cells near projectile are checked
+    # projectile pool is updated in place and returned
+    if isinstance(projs, ProjectilePool):
+        slots = projs.update(dt, now)
+        for slot, (x, y) in zip(slots.tolist(), projs.pos[slots].tolist()):
+            if index is None:
+                near = [entity for entity in [*entities, player]
+                        if (entity.pos.x - x) ** 2 + (entity.pos.y - y) ** 2 < ENTITY_HALF_SIZE**2]
+            else:
+                near = index.query(pygame.Vector2(x, y), ENTITY_HALF_SIZE)
+            damaged_entities = projs.damaged_entities[slot]
+            for entity in near:
+                if entity not in damaged_entities:
+                    entity.deal_damage(int(projs.damage[slot]), now)
+                    damaged_entities.add(entity)
+        return projs
     projectiles = []
     for proj in projs:
-        projectile = proj.update(dt)
+        projectile = proj.update(dt, now)
         if projectile:
-            for entity in [*entities, player]:
-                if (entity.pos.x - proj.pos.x) ** 2 + (entity.pos.y - proj.pos.y) ** 2 < ENTITY_HALF_SIZE**2:
-                    if entity not in proj.damaged_entities:
-                        entity.deal_damage(proj.damage, now)
-                        proj.damaged_entities.append(entity)
+            if index is None:
+                near = [entity for entity in [*entities, player]
+                        if (entity.pos.x - proj.pos.x) ** 2 + (entity.pos.y - proj.pos.y) ** 2 < ENTITY_HALF_SIZE**2]
+            else:
+                near = index.query(proj.pos, ENTITY_HALF_SIZE)
+            for entity in near:
+                if entity not in proj.damaged_entities:
+                    entity.deal_damage(proj.damage, now)
+                    proj.damaged_entities.add(entity)
 
             projectiles.append(projectile)
     return projectiles
 
-def update_entities(entities: list[EntityBasicClass]):
+def update_entities(entities: list[EntityBasicClass], index: SpatialHash = None, store: EntityStore = None):
+    # with store dead enemies are found by health column and the list is rebuilt only if someone died
+    if store is not None:
+        slots = store.slots()
+        dead = [store.entities[slot] for slot in slots[store.health[slots] <= 0].tolist()]
+        if not dead:
+            return entities
+        for entity in dead:
+            store.remove(entity)
+            if index is not None:
+                index.remove(entity)
+        dead = set(dead)
+        return [entity for entity in entities if entity not in dead]
     valid_entities = []
     for entity in entities:
         if entity.health > 0:
             valid_entities.append(entity)
+        elif index is not None:
+            index.remove(entity)
     return valid_entities
 
-def process_movement(entities:list, player: Player, level_map: list, projectiles: list, dt: int, now: int) -> None:
-    for obj in entities:
-        obj.update_ai(player, projectiles, dt, now)
-        obj.check_collision(level_map)
-        obj.move()
-    player.check_collision(level_map)
+def process_movement(entities:list, player: Player, level_map: list, projectiles: list, dt: int, now: int,
+                     index: SpatialHash = None, collision_grid: CollisionGrid = None,
+                     store: EntityStore = None, flow_field: FlowField = None) -> None:
+    # with collision grid collisions of all entities and player are resolved in one call,
+    # unless there are too few of them (COLLISION_GRID_MIN_OBJECTS)
+    # with store all entities have to be in it, they are updated by whole columns
+    # with flow field chasing enemies go around walls, see FlowField
+    if collision_grid is not None and len(entities) + 1 < COLLISION_GRID_MIN_OBJECTS:
+        collision_grid = None
+    if store is not None:
+        store.update_ai(player, projectiles, dt, now, flow_field)
+        slots = store.slots()
+        if collision_grid is not None:
+            positions = np.vstack((store.pos[slots], (player.pos.x, player.pos.y)))
+            vel = np.vstack((store.vel[slots], (player.vel.x, player.vel.y)))
+            collision_grid.resolve_arrays(positions, vel)
+            store.vel[slots] = vel[:-1]
+            player.vel = pygame.Vector2(vel[-1].tolist())
+        else:
+            for slot in slots.tolist():
+                store.entities[slot].check_collision(level_map)
+            player.check_collision(level_map)
+        if index is not None:
+            old_cells = store.pos[slots] // index.cell_size
+        store.pos[slots] += store.vel[slots]
+        store.vel[slots] = 0
+        if index is not None:
+            moved = (store.pos[slots] // index.cell_size != old_cells).any(axis=1)
+            for slot in slots[moved].tolist():
+                index.update(store.entities[slot])
+    elif collision_grid is not None:
+        for obj in entities:
+            obj.update_ai(player, projectiles, dt, now, flow_field)
+        collision_grid.resolve([*entities, player])
+        for obj in entities:
+            obj.move()
+            if index is not None:
+                index.update(obj)
+    else:
+        for obj in entities:
+            obj.update_ai(player, projectiles, dt, now, flow_field)
+            obj.check_collision(level_map)
+            obj.move()
+            if index is not None:
+                index.update(obj)
+        player.check_collision(level_map)
     player.move()
+    if index is not None:
+        index.update(player)
 
 def process_input(pressed_keys, pressed_mouse_buttons, mouse_pos, dt: int, player: Player, projectiles, now: int) -> None:
+    process_actions(pressed_keys, pressed_mouse_buttons, dt, player, projectiles, now)
+    process_look(mouse_pos, dt, player)
+
+def process_actions(pressed_keys, pressed_mouse_buttons, dt: int, player: Player, projectiles, now: int) -> None:
 
     # keyboard
     velocity = pygame.Vector2(0, 0)
@@ -510,15 +1921,64 @@ def process_input(pressed_keys, pressed_mouse_buttons, mouse_pos, dt: int, playe
             cur_weapon.start_time = now
             cur_weapon.texture.curr_frame_number = 0
             cur_weapon.texture.last_update = now
-        proj = player.cur_weapon().use(now)
-        if proj:
-            projectiles.append(proj)
+        player.cur_weapon().use(now, projectiles)
     elif cur_weapon.is_active:
         player.cur_weapon().is_active = False
-    # mouse movement
+
+def process_look(mouse_pos, dt: int, player: Player) -> None:
+    # mouse movement, once per rendered frame
     player.look_ang -= (mouse_pos[0] - DISPLAY_RESOLUTION[0] / 2) / 10 * dt
     pygame.mouse.set_pos(DISPLAY_RESOLUTION[0] / 2, DISPLAY_RESOLUTION[1] / 2)
 
+def simulation_step(pressed_keys, pressed_mouse_buttons, player: Player, entities: list, projectiles: list,
+                    level_map: list, now: int, dt=SIMULATION_DT, index: SpatialHash = None,
+                    collision_grid: CollisionGrid = None, store: EntityStore = None, flow_field: FlowField = None):
+    # one fixed simulation tick, returns alive entities and projectiles
+    def stage(name: str):
+        return profiler.stage(name) if profiler is not None else nullcontext()
+
+    with stage("input"):
+        process_actions(pressed_keys, pressed_mouse_buttons, dt, player, projectiles, now)
+    with stage("movement"):
+        process_movement(entities, player, level_map, projectiles, dt, now, index, collision_grid, store, flow_field)
+    with stage("projectiles"):
+        projectiles = process_projectiles(projectiles, entities, player, dt, now, index)
+    with stage("entities"):
+        entities = update_entities(entities, index, store)
+    return entities, projectiles
+
+
+class PositionInterpolation:
+    # renders objects between previous and current simulation step positions
+    def __init__(self):
+        self.previous = {}
+        self.objs = []
+        self.alpha = 1.0
+        self.saved = []
+
+    def store(self, objs: list):
+        self.previous = {obj: pygame.Vector2(obj.pos) for obj in objs}
+
+    def at(self, alpha: float, objs: list):
+        self.alpha = min(max(alpha, 0.0), 1.0)
+        self.objs = objs
+        return self
+
+    def __enter__(self):
+        # objects created during the last step have no previous position and stay where they are
+        for obj in self.objs:
+            previous = self.previous.get(obj)
+            if previous is not None:
+                self.saved.append((obj, obj.pos))
+                obj.pos = previous.lerp(obj.pos, self.alpha)
+        return self
+
+    def __exit__(self, *exc_info):
+        for obj, pos in self.saved:
+            obj.pos = pos
+        self.saved = []
+
+
 def init_wall(level_data: list,
               wall_type: str,
               wall_pos: pygame.Vector2,
@@ -571,16 +2031,30 @@ def is_visible(look_ang: float, pos: pygame.Vector2, point: pygame.Vector2):
     return False
 
 
-def cast_ray(ang: float, look_ang: float, player_pos: pygame.Vector2, walls: list, entities: list, projectiles: list, now: int):
-    min_distance = 1000.0
-    layers = [(min_distance, pygame.Surface((1, 1)), 1000)]
+def wall_texture_column(obj: Wall, side: tuple, inter: pygame.Vector2):
+    texture_width = obj.texture.get_width()
+    units_per_pixel = BLOCK_SIZE / texture_width
+    if side[0][0] == side[1][0]:
+        dst = abs(inter.y - side[0][1])
+    else:
+        dst = abs(inter.x - side[0][0])
+    pixel_row = int(dst // units_per_pixel)
+    # for the situation if ray got accurate in a corner of wall
+    if pixel_row == texture_width:
+        pixel_row = 0
+    return pixel_row
+
+
+def cast_walls_scan(ang: float, look_ang: float, player_pos: pygame.Vector2, walls: list):
+    # tests ray against every side of every wall, returns (distance, wall, side, pixel_row) of the closest hit
+    hit = None
+    min_distance = MAX_RENDER_DISTANCE
     if cos(ang) == 0:
         k = None
     else:
         k = -sin(ang) / cos(ang)
         b = player_pos.y - k * player_pos.x
 
-    # process walls
     for obj in walls:
         for side in obj.sides:
             if side[0][0] == side[1][0]:
@@ -604,20 +2078,297 @@ def cast_ray(ang: float, look_ang: float, player_pos: pygame.Vector2, walls: lis
                     dist = distance(inter, player_pos)
                     if min_distance > dist > MIN_RENDER_DISTANCE:
                         min_distance = dist
-                        texture_width = obj.texture.get_width()
-                        units_per_pixel = BLOCK_SIZE / texture_width
-                        if side[0][0] == side[1][0]:
-                            dst = abs(inter.y - side[0][1])
-                        else:
-                            dst = abs(inter.x - side[0][0])
-                        pixel_row = int(dst // units_per_pixel)
-                        # for the situation if ray got accurate in a corner of wall
-                        if pixel_row == texture_width:
-                            pixel_row = 0
-                        arr = pygame.PixelArray(obj.texture)
-                        if arr[pixel_row:pixel_row + 1, :]:
-                            line = arr[pixel_row:pixel_row + 1, :].make_surface()
-                            layers[0] = (dist, line, 1000)
+                        hit = (dist, obj, side, wall_texture_column(obj, side, inter))
+    return hit
+
+
+def cast_walls_segments(ang: float, look_ang: float, player_pos: pygame.Vector2, segments: list[WallSegment]):
+    # cast_walls_scan over merged wall segments, returns the same hit
+    hit = None
+    min_distance = MAX_RENDER_DISTANCE
+    if cos(ang) == 0:
+        k = None
+    else:
+        k = -sin(ang) / cos(ang)
+        b = player_pos.y - k * player_pos.x
+
+    for segment in segments:
+        start, end = segment.start, segment.end
+        if segment.is_vertical:
+            if k is None:
+                continue
+            x = start[0]
+            y = k * x + b
+            if not min(start[1], end[1]) <= y <= max(start[1], end[1]):
+                continue
+        else:
+            if k == 0:
+                continue
+            y = start[1]
+            x = player_pos.x if k is None else (y - b) / k
+            if not min(start[0], end[0]) <= x <= max(start[0], end[0]):
+                continue
+        inter = pygame.Vector2(x, y)
+        if is_visible(look_ang, player_pos, inter):
+            dist = distance(inter, player_pos)
+            if min_distance > dist > MIN_RENDER_DISTANCE:
+                min_distance = dist
+                obj, side = segment.get_block(inter)
+                hit = (dist, obj, side, wall_texture_column(obj, side, inter))
+    return hit
+
+
+def cast_walls_grid(ang: float, player_pos: pygame.Vector2, level_map: list):
+    # steps through level cells along the ray (DDA), returns the same hit as cast_walls_scan
+    dir_x = cos(ang)
+    dir_y = -sin(ang)
+    cell_x, cell_y = int(player_pos.x // BLOCK_SIZE), int(player_pos.y // BLOCK_SIZE)
+    if not (0 <= cell_y < len(level_map) and 0 <= cell_x < len(level_map[cell_y])):
+        return None
+
+    # ray length to the next vertical / horizontal cell border and between borders
+    if dir_x > 0:
+        step_x = 1
+        next_x = ((cell_x + 1) * BLOCK_SIZE - player_pos.x) / dir_x
+    elif dir_x < 0:
+        step_x = -1
+        next_x = (cell_x * BLOCK_SIZE - player_pos.x) / dir_x
+    else:
+        step_x = 0
+        next_x = float("inf")
+    if dir_y > 0:
+        step_y = 1
+        next_y = ((cell_y + 1) * BLOCK_SIZE - player_pos.y) / dir_y
+    elif dir_y < 0:
+        step_y = -1
+        next_y = (cell_y * BLOCK_SIZE - player_pos.y) / dir_y
+    else:
+        step_y = 0
+        next_y = float("inf")
+    delta_x = BLOCK_SIZE / abs(dir_x) if step_x else float("inf")
+    delta_y = BLOCK_SIZE / abs(dir_y) if step_y else float("inf")
+
+    # cell grid is read from its arrays without block objects, wall is taken only for the hit
+    if isinstance(level_map, CellGrid):
+        row_lengths, cell_types, edge_bits, width = (level_map.row_lengths, level_map.cell_types,
+                                                     level_map.edge_bits, level_map.width)
+        height = len(row_lengths)
+        # flat index of the cell, it goes by one cell along x and by row width along y
+        index = cell_y * width + cell_x
+        index_step_y = step_y * width
+        wall_type = CELL_WALL
+        prev_wall = cell_types[index] == wall_type
+        while True:
+            if next_x < next_y:
+                dist = next_x
+                next_x += delta_x
+                cell_x += step_x
+                index += step_x
+                # side of the entered cell and side of the left cell
+                enter_side, leave_side = (LEFT_SIDE, RIGHT_SIDE) if step_x > 0 else (RIGHT_SIDE, LEFT_SIDE)
+            else:
+                dist = next_y
+                next_y += delta_y
+                cell_y += step_y
+                index += index_step_y
+                enter_side, leave_side = (TOP_SIDE, BOTTOM_SIDE) if step_y > 0 else (BOTTOM_SIDE, TOP_SIDE)
+
+            if dist >= MAX_RENDER_DISTANCE:
+                return None
+            if not (0 <= cell_y < height and 0 <= cell_x < row_lengths[cell_y]):
+                return None
+
+            wall = cell_types[index] == wall_type
+            if wall != prev_wall and dist > MIN_RENDER_DISTANCE:
+                if wall:
+                    x, y, side = cell_x, cell_y, enter_side
+                elif leave_side in (LEFT_SIDE, RIGHT_SIDE):
+                    x, y, side = cell_x - step_x, cell_y, leave_side
+                else:
+                    x, y, side = cell_x, cell_y - step_y, leave_side
+                if edge_bits[y * width + x] >> side & 1:
+                    obj = level_map.wall(x, y)
+                    inter = pygame.Vector2(player_pos.x + dir_x * dist, player_pos.y + dir_y * dist)
+                    return dist, obj, obj.edges[side], wall_texture_column(obj, obj.edges[side], inter)
+            prev_wall = wall
+
+    prev_block = level_map[cell_y][cell_x]
+    while True:
+        if next_x < next_y:
+            dist = next_x
+            next_x += delta_x
+            cell_x += step_x
+            # side of the entered block and side of the left block
+            enter_side, leave_side = (LEFT_SIDE, RIGHT_SIDE) if step_x > 0 else (RIGHT_SIDE, LEFT_SIDE)
+        else:
+            dist = next_y
+            next_y += delta_y
+            cell_y += step_y
+            enter_side, leave_side = (TOP_SIDE, BOTTOM_SIDE) if step_y > 0 else (BOTTOM_SIDE, TOP_SIDE)
+
+        if dist >= MAX_RENDER_DISTANCE:
+            return None
+        if not (0 <= cell_y < len(level_map) and 0 <= cell_x < len(level_map[cell_y])):
+            return None
+
+        block = level_map[cell_y][cell_x]
+        # ray goes into a wall or out of a wall, as in scan mode both sides can be hit
+        if isinstance(block, Wall) and not isinstance(prev_block, Wall):
+            obj, side = block, block.edges[enter_side]
+        elif isinstance(prev_block, Wall) and not isinstance(block, Wall):
+            obj, side = prev_block, prev_block.edges[leave_side]
+        else:
+            side = None
+        if side and dist > MIN_RENDER_DISTANCE:
+            inter = pygame.Vector2(player_pos.x + dir_x * dist, player_pos.y + dir_y * dist)
+            return dist, obj, side, wall_texture_column(obj, side, inter)
+        prev_block = block
+
+
+def build_solid_grid(level_map: list):
+    # True for wall cells, used by batch ray casting
+    if isinstance(level_map, CellGrid):
+        return level_map.solid_grid()
+    solid = np.zeros((len(level_map), max(len(row) for row in level_map)), dtype=bool)
+    for y in range(len(level_map)):
+        for x in range(len(level_map[y])):
+            solid[y, x] = isinstance(level_map[y][x], Wall)
+    return solid
+
+
+def ray_angles(look_ang: float, fov: float, rays_amount: int):
+    # angles of screen columns from left to right
+    return look_ang + fov / 2 - np.arange(rays_amount) * (fov / rays_amount)
+
+
+def texture_column(u: float, texture_width: int):
+    pixel_row = int(u * texture_width)
+    # for the situation if ray got accurate in a corner of wall
+    if pixel_row >= texture_width:
+        pixel_row = 0
+    return pixel_row
+
+
+def cast_rays_batch(angs: np.ndarray, player_pos: pygame.Vector2, solid: np.ndarray):
+    # cast_walls_grid for all rays at once, every step moves all unfinished rays to their next cell border
+    # returns arrays: distance, side, u (hit offset along the side from its first point, 0..1), wall cell x and y
+    # rays without hit have side -1 and MAX_RENDER_DISTANCE distance
+    rays = len(angs)
+    height, width = solid.shape
+    dists = np.full(rays, float(MAX_RENDER_DISTANCE))
+    sides = np.full(rays, -1, dtype=np.int8)
+    us = np.zeros(rays)
+    hit_x = np.full(rays, -1, dtype=np.int64)
+    hit_y = np.full(rays, -1, dtype=np.int64)
+
+    start_x, start_y = int(player_pos.x // BLOCK_SIZE), int(player_pos.y // BLOCK_SIZE)
+    if not (0 <= start_x < width and 0 <= start_y < height):
+        return dists, sides, us, hit_x, hit_y
+
+    dir_x = np.cos(angs)
+    dir_y = -np.sin(angs)
+    step_x = np.sign(dir_x).astype(np.int64)
+    step_y = np.sign(dir_y).astype(np.int64)
+    cell_x = np.full(rays, start_x, dtype=np.int64)
+    cell_y = np.full(rays, start_y, dtype=np.int64)
+
+    # ray length to the next vertical / horizontal cell border and between borders
+    with np.errstate(divide="ignore", invalid="ignore"):
+        next_x = np.where(step_x != 0, ((cell_x + (step_x > 0)) * BLOCK_SIZE - player_pos.x) / dir_x, np.inf)
+        next_y = np.where(step_y != 0, ((cell_y + (step_y > 0)) * BLOCK_SIZE - player_pos.y) / dir_y, np.inf)
+        delta_x = np.where(step_x != 0, BLOCK_SIZE / np.abs(dir_x), np.inf)
+        delta_y = np.where(step_y != 0, BLOCK_SIZE / np.abs(dir_y), np.inf)
+
+    prev_solid = np.full(rays, solid[start_y, start_x])
+    active = np.ones(rays, dtype=bool)
+    while active.any():
+        along_x = next_x < next_y
+        dist = np.where(along_x, next_x, next_y)
+        next_x = np.where(along_x, next_x + delta_x, next_x)
+        next_y = np.where(along_x, next_y, next_y + delta_y)
+        cell_x = cell_x + np.where(along_x, step_x, 0)
+        cell_y = cell_y + np.where(along_x, 0, step_y)
+
+        inside = (cell_x >= 0) & (cell_x < width) & (cell_y >= 0) & (cell_y < height)
+        active &= inside & (dist < MAX_RENDER_DISTANCE)
+        cur_solid = solid[np.clip(cell_y, 0, height - 1), np.clip(cell_x, 0, width - 1)] & inside
+
+        # ray goes into a wall or out of a wall
+        hit = active & (cur_solid != prev_solid) & (dist > MIN_RENDER_DISTANCE)
+        if hit.any():
+            entering = cur_solid[hit]
+            hx = along_x[hit]
+            sx = step_x[hit]
+            sy = step_y[hit]
+            d = dist[hit]
+            wall_x = cell_x[hit] - np.where(entering, 0, np.where(hx, sx, 0))
+            wall_y = cell_y[hit] - np.where(entering, 0, np.where(hx, 0, sy))
+            side = np.where(hx,
+                            np.where((sx > 0) == entering, LEFT_SIDE, RIGHT_SIDE),
+                            np.where((sy > 0) == entering, TOP_SIDE, BOTTOM_SIDE))
+            inter_x = player_pos.x + dir_x[hit] * d
+            inter_y = player_pos.y + dir_y[hit] * d
+            # offset from the first point of the side, as in wall_texture_column
+            dst = np.select([side == LEFT_SIDE, side == TOP_SIDE, side == RIGHT_SIDE],
+                            [(wall_y + 1) * BLOCK_SIZE - inter_y, inter_x - wall_x * BLOCK_SIZE,
+                             inter_y - wall_y * BLOCK_SIZE],
+                            (wall_x + 1) * BLOCK_SIZE - inter_x)
+            dists[hit] = d
+            sides[hit] = side
+            us[hit] = np.clip(dst / BLOCK_SIZE, 0, 1)
+            hit_x[hit] = wall_x
+            hit_y[hit] = wall_y
+            active &= ~hit
+        prev_solid = cur_solid
+    return dists, sides, us, hit_x, hit_y
+
+
+def cast_ray(ang: float, look_ang: float, player_pos: pygame.Vector2, walls: list, entities: list, projectiles: list,
+             now: int, level_map: list = None, segments: list = None):
+    detailed = profiler is not None and profiler.detailed
+    if detailed:
+        start = perf_counter()
+    # process walls, grid traversal if level map is given, merged segments (see merge_wall_sides) if given
+    if level_map is not None:
+        hit = cast_walls_grid(ang, player_pos, level_map)
+    elif segments is not None:
+        hit = cast_walls_segments(ang, look_ang, player_pos, segments)
+    else:
+        hit = cast_walls_scan(ang, look_ang, player_pos, walls)
+    if detailed:
+        profiler.add_time("ray walls", perf_counter() - start)
+    return ray_layers(ang, look_ang, player_pos, hit, entities, projectiles, now)
+
+
+def ray_layers(ang: float, look_ang: float, player_pos: pygame.Vector2, hit: tuple, entities: list, projectiles: list,
+               now: int):
+    # builds ray layers from wall hit (distance, wall, side, pixel_row) and from entities and projectiles before it
+    min_distance = float(MAX_RENDER_DISTANCE)
+    layers = [(min_distance, pygame.Surface((1, 1)), 1000)]
+
+    if hit:
+        dist, obj, side, pixel_row = hit
+        min_distance = dist
+        if 0 <= pixel_row < len(obj.columns.columns):
+            layers[0] = (dist, obj.columns.get_column(pixel_row), 1000)
+
+    layers += object_layers(ang, look_ang, player_pos, min_distance, entities, projectiles, now)
+    layers.sort(key=lambda l: l[0], reverse=True)
+    return layers
+
+
+def object_layers(ang: float, look_ang: float, player_pos: pygame.Vector2, min_distance: float, entities: list,
+                  projectiles: list, now: int):
+    # layers of entities and projectiles hit by ray closer than min_distance, not sorted
+    layers = []
+    if cos(ang) == 0:
+        k = None
+    else:
+        k = -sin(ang) / cos(ang)
+        b = player_pos.y - k * player_pos.x
+    detailed = profiler is not None and profiler.detailed
+    if detailed:
+        start = perf_counter()
 
     # process entities
     for obj in entities:
@@ -662,6 +2413,10 @@ def cast_ray(ang: float, look_ang: float, player_pos: pygame.Vector2, walls: lis
                     line = arr[pixel_row:pixel_row + 1, :].make_surface()
                     layers.append((dist, line, 1000))
 
+    if detailed:
+        after_entities = perf_counter()
+        profiler.add_time("ray entities", after_entities - start)
+
     # process projectiles
     for obj in projectiles:
         for line in obj.get_lines():
@@ -697,40 +2452,486 @@ def cast_ray(ang: float, look_ang: float, player_pos: pygame.Vector2, walls: lis
                         layer = pygame.Surface((1, 1))
                         layer.fill(obj.color)
                         layers.append((dist, layer, 50))
+    if detailed:
+        profiler.add_time("ray projectiles", perf_counter() - after_entities)
+    return layers
+
+@lru_cache(maxsize=4096)
+def column_rows(height: int, top: int, texture_height: int):
+    # texture row for every screen row of a column drawn from top with height, texture_height outside of the column
+    rows = np.full(DISPLAY_RESOLUTION[1], texture_height, dtype=np.int32)
+    start = max(top, 0)
+    end = min(top + height, DISPLAY_RESOLUTION[1])
+    if end > start:
+        rows[start:end] = (np.arange(start, end) - top) * texture_height // height
+    rows.flags.writeable = False
+    return rows
+
+
+def layer_rows(dist: float, height_factor: int, texture_height: int):
+    layer_height = BLOCK_SIZE / dist * height_factor
+    return column_rows(int(layer_height), int((DISPLAY_RESOLUTION[1] - layer_height) / 2), texture_height)
+
+
+def layers_rows(dists: np.ndarray, height_factor: int, texture_height: int):
+    # layer_rows for many distances at once, (len(dists), screen height)
+    # neighbour columns mostly have the same layer height, so rows are made only for distinct ones
+    layer_heights = BLOCK_SIZE / dists * height_factor
+    heights = layer_heights.astype(np.int64)
+    tops = ((DISPLAY_RESOLUTION[1] - layer_heights) / 2).astype(np.int64)
+    layers, inverse = np.unique(np.stack((heights, tops), axis=1), axis=0, return_inverse=True)
+    rows = np.stack([column_rows(height, top, texture_height) for height, top in layers.tolist()])
+    return rows[inverse.reshape(-1)]
+
+
+class Compositor:
+    def __init__(self, background="grey", workers=1):
+        self.background = pygame.Color(background)
+        # with several workers walls of column strips are cast and drawn in threads, numpy releases GIL there
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(workers) if workers > 1 else None
+        self.surface = None
+        self.pixels = None
+        # TextureColumns -> mapped texture pixels with background pixel as the last row
+        self.textures = {}
+        # sprite texture -> colors and alpha, least recently used first
+        self.sprites = OrderedDict()
+        self.sprites_cache_size = 256
+
+    def resize(self, screen: pygame.Surface, columns: int):
+        # framebuffer is one pixel per ray, it is reallocated only if rays amount changes,
+        # mapped textures depend only on pixel format and are kept
+        if self.pixels is None or self.pixels.shape[0] != columns:
+            first = self.surface is None
+            self.surface = pygame.Surface((columns, DISPLAY_RESOLUTION[1]), 0, screen)
+            self.pixels = pygame.surfarray.array2d(self.surface)
+            if first:
+                # rays that didn't hit any wall
+                no_hit = pygame.Surface((1, 1), 0, self.surface)
+                no_hit.fill("black")
+                self.no_hit = self.map_texture(no_hit)
+
+    def map_texture(self, texture: pygame.Surface):
+        pixels = pygame.surfarray.array2d(texture.convert(self.surface))
+        background = np.full((pixels.shape[0], 1), self.surface.map_rgb(self.background), dtype=pixels.dtype)
+        return np.concatenate((pixels, background), axis=1)
+
+    def unmap(self, pixels: np.ndarray):
+        masks = self.surface.get_masks()
+        shifts = self.surface.get_shifts()
+        return np.stack([(pixels & masks[i]) >> shifts[i] for i in range(3)], axis=-1)
+
+    def map(self, colors: np.ndarray):
+        shifts = self.surface.get_shifts()
+        colors = colors.astype(self.pixels.dtype)
+        return (colors[..., 0] << shifts[0]) | (colors[..., 1] << shifts[1]) | (colors[..., 2] << shifts[2])
+
+    def texture_pixels(self, columns: TextureColumns):
+        texture_pixels = self.textures.get(columns)
+        if texture_pixels is None:
+            texture_pixels = self.map_texture(columns.texture)
+            self.textures[columns] = texture_pixels
+        return texture_pixels
+
+    def draw_walls(self, hits: list, pixels: np.ndarray = None):
+        # columns with the same texture are drawn together, rows outside of wall get background
+        # pixels are framebuffer columns for hits, whole framebuffer by default
+        if pixels is None:
+            pixels = self.pixels
+        groups = {}
+        for i, hit in enumerate(hits):
+            if hit and 0 <= hit[3] < len(hit[1].columns.columns):
+                key = hit[1].columns
+                dist, pixel_row = hit[0], hit[3]
+            else:
+                key = None
+                dist, pixel_row = MAX_RENDER_DISTANCE, 0
+            groups.setdefault(key, []).append((i, dist, pixel_row))
+
+        for columns, group in groups.items():
+            texture_pixels = self.no_hit if columns is None else self.texture_pixels(columns)
+            texture_height = texture_pixels.shape[1] - 1
+            rows = np.stack([layer_rows(dist, 1000, texture_height) for i, dist, pixel_row in group])
+            # flat indexes into texture pixels
+            pixel_rows = np.array([pixel_row for i, dist, pixel_row in group], dtype=np.int32)
+            rows += pixel_rows[:, None] * (texture_height + 1)
+            if len(group) == len(hits):
+                # see draw_wall_arrays about clip mode
+                np.take(texture_pixels, rows, out=pixels, mode="clip")
+            else:
+                pixels[[i for i, dist, pixel_row in group]] = np.take(texture_pixels, rows)
+
+    def draw_wall_arrays(self, dists: np.ndarray, sides: np.ndarray, us: np.ndarray, columns: TextureColumns,
+                         pixels: np.ndarray):
+        # draw_walls for cast_rays_batch results when all walls have the same texture columns, no per ray python
+        texture_pixels = self.texture_pixels(columns)
+        texture_width, texture_height = texture_pixels.shape[0], texture_pixels.shape[1] - 1
+        hit = sides >= 0
+        # as texture_column
+        pixel_rows = np.where(hit, us * texture_width, 0).astype(np.int64)
+        pixel_rows[pixel_rows >= texture_width] = 0
+        rows = layers_rows(np.where(hit, dists, MAX_RENDER_DISTANCE), 1000, texture_height)
+        rows += (pixel_rows * (texture_height + 1))[:, None].astype(rows.dtype)
+        # rows are always in texture, clip mode writes straight into out while raise mode buffers it
+        np.take(texture_pixels, rows, out=pixels, mode="clip")
+        if not hit.all():
+            pixels[~hit] = np.take(self.no_hit, layer_rows(MAX_RENDER_DISTANCE, 1000, 1))
+
+    def cast_draw_walls(self, screen: pygame.Surface, angs: list, look_ang: float, player_pos: pygame.Vector2,
+                        walls: list, level_map: list = None, solid_grid: np.ndarray = None, segments: list = None):
+        # casts and draws walls straight into the framebuffer, returns walls depth for every column
+        # with several workers every worker does its own strip of columns
+        # cell grid with solid grid goes from cast_rays_batch arrays to pixels without per ray python,
+        # so most of the strip time is in numpy which releases GIL
+        self.resize(screen, len(angs))
+        array_walls = solid_grid is not None and isinstance(level_map, CellGrid)
+
+        def draw_strip(start: int, end: int):
+            if array_walls:
+                dists, sides, us, hit_x, hit_y = cast_rays_batch(np.asarray(angs[start:end]), player_pos, solid_grid)
+                self.draw_wall_arrays(dists, sides, us, get_texture_columns(level_map.wall_texture),
+                                      self.pixels[start:end])
+                return np.where(sides >= 0, dists, MAX_RENDER_DISTANCE)
+            hits = cast_walls(angs[start:end], look_ang, player_pos, walls, level_map, solid_grid, segments)
+            self.draw_walls(hits, self.pixels[start:end])
+            return np.array([hit[0] if hit else MAX_RENDER_DISTANCE for hit in hits], dtype=float)
+
+        if self.executor is None:
+            return draw_strip(0, len(angs))
+        bounds = np.linspace(0, len(angs), min(self.workers, len(angs)) + 1).astype(int).tolist()
+        strips = [self.executor.submit(draw_strip, start, end) for start, end in zip(bounds, bounds[1:])]
+        return np.concatenate([strip.result() for strip in strips])
+
+    def sprite_pixels(self, texture: pygame.Surface):
+        # colors and alpha of texture with transparent pixel as the last row
+        pixels = self.sprites.get(texture)
+        if pixels is None:
+            colors = pygame.surfarray.array3d(texture)
+            colors = np.concatenate((colors, np.zeros((colors.shape[0], 1, 3), dtype=colors.dtype)), axis=1)
+            alpha = pygame.surfarray.array_alpha(texture)
+            alpha = np.concatenate((alpha, np.zeros((alpha.shape[0], 1), dtype=alpha.dtype)), axis=1)
+            pixels = (colors, alpha)
+            self.sprites[texture] = pixels
+            if len(self.sprites) > self.sprites_cache_size:
+                self.sprites.popitem(last=False)
+        else:
+            self.sprites.move_to_end(texture)
+        return pixels
+
+    def draw_sprite(self, columns: np.ndarray, dists: np.ndarray, us: np.ndarray, texture: pygame.Surface):
+        colors, alpha = self.sprite_pixels(texture)
+        texture_width, texture_height = texture.get_size()
+        pixel_rows = (us * texture_width).astype(np.int64)
+        # for the situation if ray got accurate in end
+        pixel_rows[pixel_rows >= texture_width] = 0
+        rows = np.stack([layer_rows(dist, 1000, texture_height) for dist in dists.tolist()])
+        # only screen rows that sprite covers
+        covered = np.nonzero((rows < texture_height).any(axis=0))[0]
+        if not len(covered):
+            return
+        rows = rows[:, covered[0]:covered[-1] + 1]
+        src_alpha = alpha[pixel_rows[:, None], rows]
+        drawn = src_alpha > 0
+        src_alpha = src_alpha[drawn][:, None].astype(np.float32) / 255
+        src_colors = colors[pixel_rows[:, None], rows][drawn]
+        pixels = self.pixels[columns, covered[0]:covered[-1] + 1]
+        pixels[drawn] = self.map(src_colors * src_alpha + self.unmap(pixels[drawn]) * (1 - src_alpha))
+        self.pixels[columns, covered[0]:covered[-1] + 1] = pixels
+
+    def draw_line(self, columns: np.ndarray, dists: np.ndarray, color):
+        rows = np.stack([layer_rows(dist, 50, 1) for dist in dists.tolist()])
+        pixels = self.pixels[columns]
+        pixels[rows == 0] = self.surface.map_rgb(pygame.Color(color))
+        self.pixels[columns] = pixels
+
+    def draw_objects(self, angs: list, look_ang: float, player_pos: pygame.Vector2, depth: np.ndarray,
+                     entities: list, projectiles: list, now: int):
+        # entities and projectiles are projected to screen once per frame and drawn from far to near
+        # only in columns where they are in front of walls
+        detailed = profiler is not None and profiler.detailed
+        if detailed:
+            start = perf_counter()
+        ray_offsets = np.asarray(angs) - look_ang
+        tans = np.tan(ray_offsets)
+        look_x, look_y = cos(look_ang), -sin(look_ang)
+        objects = []
+
+        for obj in entities:
+            projection = project_billboard(obj.pos, player_pos, look_x, look_y, tans, ray_offsets, depth)
+            if projection is not None:
+                objects.append((distance(obj.pos, player_pos), obj, projection))
+
+        if detailed:
+            after_entities = perf_counter()
+        ray_x = np.cos(angs)
+        ray_y = -np.sin(angs)
+        for obj in projectiles:
+            for line in obj.get_lines():
+                projection = project_segment(line, player_pos, ray_x, ray_y, depth)
+                if projection is not None:
+                    objects.append((distance(obj.pos, player_pos), obj, projection))
+
+        objects.sort(key=lambda o: o[0], reverse=True)
+        for dist, obj, (columns, dists, us) in objects:
+            if us is None:
+                self.draw_line(columns, dists, obj.color)
+            else:
+                self.draw_sprite(columns, dists, us, obj.get_cur_texture(now))
+        if detailed:
+            end = perf_counter()
+            profiler.add_time("ray entities", after_entities - start)
+            profiler.add_time("ray projectiles", end - after_entities)
+
+    def draw(self, screen: pygame.Surface, angs: list, look_ang: float, player_pos: pygame.Vector2,
+             depth: np.ndarray, entities: list, projectiles: list, now: int):
+        # walls are already in framebuffer after cast_draw_walls, depth is its result
+        if entities or projectiles:
+            self.draw_objects(angs, look_ang, player_pos, depth, entities, projectiles, now)
+
+        # present frame at once, stretched to screen width
+        pygame.surfarray.blit_array(self.surface, self.pixels)
+        if self.surface.get_size() == screen.get_size():
+            screen.blit(self.surface, (0, 0))
+        else:
+            pygame.transform.scale(self.surface, screen.get_size(), screen)
 
 
-    layers.sort(key=lambda l: l[0], reverse=True)
-    return layers
+def project_billboard(pos: pygame.Vector2, player_pos: pygame.Vector2, look_x: float, look_y: float,
+                      tans: np.ndarray, ray_offsets: np.ndarray, depth: np.ndarray):
+    # entity is a segment facing player, returns its visible (columns, distances, texture u) or None
+    rel_x, rel_y = pos.x - player_pos.x, pos.y - player_pos.y
+    # distance along look direction and shift to the left of it
+    forward = rel_x * look_x + rel_y * look_y
+    side = rel_x * look_y - rel_y * look_x
+    if forward <= 0:
+        return None
+    # columns go from left to right, so tans are decreasing
+    first = np.searchsorted(-tans, -(side + ENTITY_HALF_SIZE) / forward, "right")
+    last = np.searchsorted(-tans, -(side - ENTITY_HALF_SIZE) / forward, "left")
+    if first >= last:
+        return None
+    columns = np.arange(first, last)
+    shifts = forward * tans[first:last] - side
+    dists = forward / np.cos(ray_offsets[first:last])
+    visible = (np.abs(shifts) < ENTITY_HALF_SIZE) & (dists > MIN_RENDER_DISTANCE) & (dists < depth[first:last])
+    if not visible.any():
+        return None
+    us = (ENTITY_HALF_SIZE - shifts[visible]) / ENTITY_SIZE
+    return columns[visible], dists[visible], us
+
+
+def project_segment(line: tuple, player_pos: pygame.Vector2, ray_x: np.ndarray, ray_y: np.ndarray,
+                    depth: np.ndarray):
+    # line is (start, unit direction, length), returns its visible (columns, distances, None) or None
+    start, direction, length = line
+    to_player_x, to_player_y = player_pos.x - start.x, player_pos.y - start.y
+    with np.errstate(divide="ignore", invalid="ignore"):
+        det = ray_x * direction.y - direction.x * ray_y
+        along = (ray_x * to_player_y - ray_y * to_player_x) / det
+        dists = (direction.x * to_player_y - direction.y * to_player_x) / det
+        visible = (det != 0) & (along > 0) & (along < length) & (dists > MIN_RENDER_DISTANCE) & (dists < depth)
+    if not visible.any():
+        return None
+    columns = np.nonzero(visible)[0]
+    return columns, dists[columns], None
+
+
+class PotentiallyVisibleSet:
+    def __init__(self, bits: np.ndarray, region_size: int, shape: tuple):
+        # compute_pvs result, see compile_level(pvs=True), shape is level cells shape
+        self.bits = bits
+        self.region_size = region_size
+        self.reach, self.window = pvs_window(region_size)
+        self.height, self.width = shape
+        # the last visible_mask result is kept while player stays in the same region
+        self.region = None
+        self.mask = None
+
+    def visible_mask(self, pos: pygame.Vector2):
+        # flat bool mask of cells that can be seen from pos, None if pos is out of the level
+        x, y = int(pos.x // BLOCK_SIZE), int(pos.y // BLOCK_SIZE)
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return None
+        region = (y // self.region_size, x // self.region_size)
+        if region != self.region:
+            window = np.unpackbits(self.bits[region], count=self.window * self.window).reshape(
+                self.window, self.window).astype(bool)
+            start_y = region[0] * self.region_size - self.reach
+            start_x = region[1] * self.region_size - self.reach
+            # window part inside the level
+            top, left = max(0, -start_y), max(0, -start_x)
+            bottom = min(self.window, self.height - start_y)
+            right = min(self.window, self.width - start_x)
+            mask = np.zeros((self.height, self.width), dtype=bool)
+            mask[start_y + top:start_y + bottom, start_x + left:start_x + right] = window[top:bottom, left:right]
+            self.region, self.mask = region, mask.ravel()
+        return self.mask
+
+    def cells_of(self, positions: np.ndarray):
+        # flat cell indexes of (n, 2) positions, positions out of the level get -1
+        x = (positions[:, 0] // BLOCK_SIZE).astype(np.int64)
+        y = (positions[:, 1] // BLOCK_SIZE).astype(np.int64)
+        inside = (x >= 0) & (x < self.width) & (y >= 0) & (y < self.height)
+        return np.where(inside, y * self.width + x, -1)
+
+
+class FrustumCuller:
+    def __init__(self, walls: list[Wall] = None, segments: list[WallSegment] = None,
+                 pvs: PotentiallyVisibleSet = None):
+        # walls and segments are static, their bounding circles are computed once
+        # without walls only entities and projectiles are culled, for walls cast by level map grid
+        self.walls = walls
+        self.wall_centers = np.array([(wall.pos.x, wall.pos.y) for wall in walls or []],
+                                     dtype=float).reshape(-1, 2)
+        self.wall_radius = BLOCK_SIZE * sqrt(2) / 2
+        self.segments = segments
+        if segments is not None:
+            self.segment_centers = np.array([((s.start[0] + s.end[0]) / 2, (s.start[1] + s.end[1]) / 2)
+                                             for s in segments], dtype=float).reshape(-1, 2)
+            self.segment_radii = np.array([distance(pygame.Vector2(s.start), pygame.Vector2(s.end)) / 2
+                                           for s in segments], dtype=float)
+        self.pvs = pvs
+        if pvs is not None:
+            self.wall_cells = pvs.cells_of(self.wall_centers)
+            if segments is not None:
+                # cells of all segments walls one after another
+                self.segment_cells = pvs.cells_of(np.array(
+                    [(wall.pos.x, wall.pos.y) for s in segments for wall in s.walls], dtype=float).reshape(-1, 2))
+                self.segment_starts = np.cumsum([0] + [len(s.walls) for s in segments[:-1]])
+        # objects kept by the last cull: walls, segments, entities, projectiles
+        self.last_counts = (0, 0, 0, 0)
+
+    def in_frustum(self, centers: np.ndarray, radii, player: Player):
+        # bounding circles that touch the field of view wedge and are not farther than render distance
+        rel_x = centers[:, 0] - player.pos.x
+        rel_y = centers[:, 1] - player.pos.y
+        dists = np.hypot(rel_x, rel_y)
+        look_x, look_y = cos(player.look_ang), -sin(player.look_ang)
+        offsets = np.abs(np.arctan2(look_x * rel_y - look_y * rel_x, look_x * rel_x + look_y * rel_y))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            spread = np.arcsin(np.minimum(1, radii / dists))
+        return (dists <= radii) | ((dists - radii < MAX_RENDER_DISTANCE) & (offsets <= player.fov / 2 + spread))
+
+    def in_pvs(self, cells: np.ndarray, visible: np.ndarray):
+        return (cells >= 0) & visible[np.maximum(cells, 0)]
+
+    def cull(self, player: Player, entities: list, projectiles: list):
+        # walls, segments (None without them), entities and projectiles that can be seen by player
+        visible = None if self.pvs is None else self.pvs.visible_mask(player.pos)
+
+        walls = None
+        if self.walls is not None:
+            walls_mask = self.in_frustum(self.wall_centers, self.wall_radius, player)
+            if visible is not None:
+                walls_mask &= self.in_pvs(self.wall_cells, visible)
+            walls = [self.walls[i] for i in np.flatnonzero(walls_mask).tolist()]
+
+        segments = None
+        if self.segments is not None:
+            segments_mask = self.in_frustum(self.segment_centers, self.segment_radii, player)
+            if visible is not None and len(self.segments):
+                segments_mask &= np.logical_or.reduceat(self.in_pvs(self.segment_cells, visible),
+                                                        self.segment_starts)
+            segments = [self.segments[i] for i in np.flatnonzero(segments_mask).tolist()]
+
+        objs = []
+        for group, radius in ((list(entities), ENTITY_HALF_SIZE), (list(projectiles), None)):
+            if not group:
+                objs.append(group)
+                continue
+            centers = np.array([(obj.pos.x, obj.pos.y) for obj in group], dtype=float)
+            # projectile lines start at its position
+            radii = radius if radius is not None else np.array([obj.length + obj.width for obj in group])
+            mask = self.in_frustum(centers, radii, player)
+            if visible is not None:
+                mask &= self.in_pvs(self.pvs.cells_of(centers), visible)
+            objs.append([group[i] for i in np.flatnonzero(mask).tolist()])
+
+        self.last_counts = (0 if walls is None else len(walls), 0 if segments is None else len(segments),
+                            len(objs[0]), len(objs[1]))
+        return walls, segments, objs[0], objs[1]
+
+
+def cast_walls(angs: list, look_ang: float, player_pos: pygame.Vector2, walls: list, level_map: list = None,
+               solid_grid: np.ndarray = None, segments: list = None):
+    # wall hit (distance, wall, side, pixel_row) or None for every ray
+    if solid_grid is not None:
+        hits = []
+        wall_dists, wall_sides, wall_us, wall_xs, wall_ys = [
+            arr.tolist() for arr in cast_rays_batch(np.asarray(angs), player_pos, solid_grid)]
+        # cell grid gives walls without row objects
+        wall_at = level_map.wall if isinstance(level_map, CellGrid) else lambda x, y: level_map[y][x]
+        for i in range(len(angs)):
+            hit = None
+            if wall_sides[i] >= 0:
+                obj = wall_at(wall_xs[i], wall_ys[i])
+                pixel_row = texture_column(wall_us[i], obj.texture.get_width())
+                hit = (wall_dists[i], obj, obj.edges[wall_sides[i]], pixel_row)
+            hits.append(hit)
+        return hits
+    if level_map is not None:
+        return [cast_walls_grid(ang, player_pos, level_map) for ang in angs]
+    if segments is not None:
+        return [cast_walls_segments(ang, look_ang, player_pos, segments) for ang in angs]
+    return [cast_walls_scan(ang, look_ang, player_pos, walls) for ang in angs]
+
 
 def render_image(screen: pygame.Surface, player: Player, walls: list, entities: list, projectiles: list,
-                 rays_amount: int, now: int, mode=0):
+                 rays_amount: int, now: int, mode=0, level_map: list = None, solid_grid: np.ndarray = None,
+                 compositor: Compositor = None, segments: list = None, culler: FrustumCuller = None):
+    # walls are cast by scanning walls list or merged wall segments if they are given,
+    # by grid traversal if level map is given or for all rays at once if solid grid (see build_solid_grid) is given too
+    # with compositor all columns are drawn into its framebuffer and shown at once,
+    # compositor with several workers casts and draws walls by column strips in parallel
+    # culler leaves only walls, segments and objects in field of view (and potentially visible set) for rays
 
     pos = player.pos
     look_ang = player.look_ang
     fov = player.fov
 
-    ang_between_rays = fov / rays_amount
-    ang = look_ang + fov / 2
+    detailed = profiler is not None and profiler.detailed
+    if culler is not None:
+        if detailed:
+            start = perf_counter()
+        culled_walls, culled_segments, entities, projectiles = culler.cull(player, entities, projectiles)
+        if culled_walls is not None:
+            walls = culled_walls
+        if segments is not None:
+            segments = culled_segments
+        if detailed:
+            profiler.add_time("cull", perf_counter() - start)
+
+    angs = ray_angles(look_ang, fov, rays_amount).tolist()
+    if detailed:
+        start = perf_counter()
+    # compositor draws walls right after casting them, so for it the stage includes drawing
+    if compositor is not None and mode == 0:
+        depth = compositor.cast_draw_walls(screen, angs, look_ang, pos, walls, level_map, solid_grid, segments)
+    else:
+        hits = cast_walls(angs, look_ang, pos, walls, level_map, solid_grid, segments)
+    if detailed:
+        profiler.add_time("ray walls", perf_counter() - start)
 
     weapon = pygame.transform.scale(player.cur_weapon().get_cur_texture(now), (400, 400))
 
-    for i in range(rays_amount):
-        layers = cast_ray(ang, look_ang, pos, walls, entities, projectiles, now)
-        width = DISPLAY_RESOLUTION[0] / rays_amount
+    if compositor is not None and mode == 0:
+        compositor.draw(screen, angs, look_ang, pos, depth, entities, projectiles, now)
+    else:
+        for i, ang in enumerate(angs):
+            layers = ray_layers(ang, look_ang, pos, hits[i], entities, projectiles, now)
+            width = DISPLAY_RESOLUTION[0] / rays_amount
 
-        if mode == 0:
-            pixels = pygame.Surface((ceil(width), DISPLAY_RESOLUTION[1]))
-        else:
-            height = BLOCK_SIZE / layers[0][0] * 1000
-            pixels = pygame.Surface((ceil(width), height))
-        pixels.fill("grey")
-        for j in layers:
-            layer_height = BLOCK_SIZE / j[0] * j[2]
-            layer_line = pygame.transform.scale(j[1], (ceil(width), layer_height))
-            pixels.blit(layer_line, (0, (DISPLAY_RESOLUTION[1] - layer_height) / 2))
+            if mode == 0:
+                pixels = pygame.Surface((ceil(width), DISPLAY_RESOLUTION[1]))
+            else:
+                # only the part over the screen bottom is seen
+                height = min(BLOCK_SIZE / layers[0][0] * 1000, DISPLAY_RESOLUTION[1])
+                pixels = pygame.Surface((ceil(width), height))
+            pixels.fill("grey")
+            for j in layers:
+                draw_column(pixels, j[1], ceil(width), BLOCK_SIZE / j[0] * j[2])
 
-        screen.blit(pixels, (i * width, 0))
+            screen.blit(pixels, (i * width, 0))
 
-        ang -= ang_between_rays
     weapon_pos = ((DISPLAY_RESOLUTION[0] - weapon.get_width()) // 2, DISPLAY_RESOLUTION[1] - weapon.get_height())
     screen.blit(weapon, weapon_pos)
@@ -1,6 +1,13 @@
 import pygame
-from lib import (DISPLAY_RESOLUTION, process_projectiles, render_image, process_input, process_movement, RAYS_AMOUNT,
-                 load_level, draw_minimap, update_entities, is_player_dead)
+from lib import (DISPLAY_RESOLUTION, render_image, process_look, simulation_step, RAYS_AMOUNT, SIMULATION_DT,
+                 MAX_SIMULATION_STEPS, RENDER_WORKERS, load_level, draw_minimap, is_player_dead, build_solid_grid,
+                 Compositor, SpatialHash, FrameProfiler, set_profiler, CollisionGrid, PositionInterpolation,
+                 ResolutionGovernor, EntityStore, ProjectilePool, FrustumCuller, SimulationClock, FlowField)
+
+# F3 - show stage timings, F4 - save chrome trace of last frames
+PROFILER_OVERLAY_KEY = pygame.K_F3
+PROFILER_TRACE_KEY = pygame.K_F4
+PROFILER_TRACE_PATH = "profile_trace.json"
 
 
 pygame.init()
@@ -9,19 +16,7 @@ clock = pygame.time.Clock()
 running = True
 dt = 0
 
-# init textures
-
-# stone_wall_1
-stone_wall_1_texture = pygame.image.load("./textures/stone_wall_1.jpg").convert()
-
-# pelmen_king
-pelmen_king_frames = []
-for i in range(12):
-    frame = pygame.image.load(f"./textures/pelmen_king/{i}.png").convert_alpha()
-    pelmen_king_frames.append(frame)
-
-# load level
-file = open("levels/level_3.txt", "r")
+# textures are loaded by load_level through shared lib.assets registry
 
 '''
 level symbols designations:
@@ -33,46 +28,84 @@ level symbols designations:
     ...
 '''
 
-# read level data
-level_data = [i.rstrip() for i in file.readlines()]
-
-
 #process level data
-player, level_objs_map, walls, entities, minimap = load_level(screen, "levels/level_3.txt")
-projectiles = []
+# enemies state is kept in numpy columns of entity store
+entity_store = EntityStore()
+player, level_objs_map, entities, minimap = load_level(screen, "levels/level_3.txt", entity_store)
+# entities and projectiles out of view are dropped before ray casting, walls are cast by solid grid
+culler = FrustumCuller()
+solid_grid = build_solid_grid(level_objs_map)
+compositor = Compositor(workers=RENDER_WORKERS)
+entity_index = SpatialHash([*entities, player])
+collision_grid = CollisionGrid(level_objs_map)
+# paths around walls to player, shared by all chasing enemies
+flow_field = FlowField(level_objs_map)
+profiler = FrameProfiler(detailed=True)
+set_profiler(profiler)
+# projectiles live in preallocated reused slots
+projectiles = ProjectilePool()
+interpolation = PositionInterpolation()
+# rays amount follows frame time, compositor stretches frame to the screen
+governor = ResolutionGovernor()
+rays_amount = RAYS_AMOUNT
+# simulation time goes by fixed steps, frame time that is not simulated yet is in seconds
+sim_clock = SimulationClock(pygame.time.get_ticks())
+accumulator = 0.0
 
 in_level = True
 while in_level:
+    profiler.begin_frame()
     for event in pygame.event.get():
         if event.type == pygame.QUIT:
             in_level = False
+        elif event.type == pygame.KEYDOWN:
+            if event.key == PROFILER_OVERLAY_KEY:
+                profiler.show_overlay = not profiler.show_overlay
+            elif event.key == PROFILER_TRACE_KEY:
+                profiler.dump_trace(PROFILER_TRACE_PATH)
 
     # get input
     pressed_keys = pygame.key.get_pressed()
     pressed_mouse_buttons = pygame.mouse.get_pressed()
     mouse_pos = pygame.mouse.get_pos()
 
-    now = pygame.time.get_ticks()
-
-    process_input(pressed_keys, pressed_mouse_buttons, mouse_pos, dt, player, projectiles, now)
-
-    process_movement(entities, player, level_objs_map, projectiles, dt, now)
-
-
-    projectiles = process_projectiles(projectiles, entities, player, dt, now)
-    entities = update_entities(entities)
-
-    if is_player_dead(player):
-        in_level = False
-
-    # render image
-    render_image(screen, player, walls, entities, projectiles, RAYS_AMOUNT, now)
-    draw_minimap(screen, minimap, player)
+    with profiler.stage("input"):
+        process_look(mouse_pos, dt, player)
+
+    # fixed simulation steps for the time passed since the previous frame
+    accumulator += dt
+    steps = min(int(accumulator / SIMULATION_DT), MAX_SIMULATION_STEPS)
+    for step in range(steps):
+        if step == steps - 1:
+            interpolation.store([player, *entities, *projectiles])
+        entities, projectiles = simulation_step(pressed_keys, pressed_mouse_buttons, player, entities, projectiles,
+                                                level_objs_map, sim_clock.now(), SIMULATION_DT, entity_index,
+                                                collision_grid, entity_store, flow_field)
+        sim_clock.advance(SIMULATION_DT * 1000)
+        accumulator -= SIMULATION_DT
+        if is_player_dead(player):
+            in_level = False
+            break
+    if steps == MAX_SIMULATION_STEPS:
+        accumulator = min(accumulator, SIMULATION_DT)
+
+    # render image between the last two simulation steps
+    with interpolation.at(accumulator / SIMULATION_DT, [player, *entities, *projectiles]):
+        with profiler.stage("render"):
+            render_image(screen, player, None, entities, projectiles, rays_amount, sim_clock.now(),
+                         level_map=level_objs_map, solid_grid=solid_grid, compositor=compositor, culler=culler)
+        with profiler.stage("minimap"):
+            draw_minimap(screen, minimap, player)
+    profiler.draw_overlay(screen, (0 if minimap is None else minimap.get_width(), 0))
 
     # show on display
-    pygame.display.update()
+    with profiler.stage("display"):
+        pygame.display.update()
+    profiler.end_frame()
 
     # get dt and wait
     dt = clock.tick(60) / 1000
+    # time without waiting
+    rays_amount = governor.update(clock.get_rawtime() / 1000)
 
 pygame.quit()
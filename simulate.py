@@ -0,0 +1,173 @@
+import os
+
+# sessions run without window and sound
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+# SDL would turn SIGTERM into quit event, then pool could not terminate its workers
+os.environ.setdefault("SDL_NO_SIGNAL_HANDLERS", "1")
+
+import argparse
+import json
+import multiprocessing
+import random
+import sys
+import tempfile
+from time import perf_counter
+
+import pygame
+from lib import (SIMULATION_DT, load_level, load_compiled_level, simulation_step, process_look, is_player_dead,
+                 SpatialHash, CollisionGrid, EntityStore, ProjectilePool, SimulationClock, FrameProfiler,
+                 set_profiler, FlowField)
+from bench import INPUT_SCRIPT, scripted_input, generate_level, summary
+
+
+STAGES = ("input", "movement", "projectiles", "entities")
+MOVE_KEYS = (pygame.K_w, pygame.K_a, pygame.K_s, pygame.K_d, pygame.K_LSHIFT)
+
+
+def idle_script(rng: random.Random):
+    return ((1, (), (0, 0, 0), 0),)
+
+
+def patrol_script(rng: random.Random):
+    # bench script, steps are twice longer as ticks are twice shorter than bench frames
+    return tuple((length * 2, keys, buttons, mouse_shift) for length, keys, buttons, mouse_shift in INPUT_SCRIPT)
+
+
+def random_script(rng: random.Random, steps=64):
+    return tuple((rng.randint(30, 240), tuple(rng.sample(MOVE_KEYS, rng.randint(0, 2))),
+                  (int(rng.random() < 0.5), 0, 0), rng.randint(-100, 100)) for _ in range(steps))
+
+
+# behaviour name -> input script for a seeded random generator, see bench.scripted_input
+BEHAVIOURS = {
+    "idle": idle_script,
+    "patrol": patrol_script,
+    "random": random_script,
+}
+# behaviours whose script depends on the seed, others are the same session for every seed and run once
+SEEDED_BEHAVIOURS = ("random",)
+
+
+def init_worker():
+    # load_level converts textures, so every worker needs a (dummy) display
+    pygame.init()
+    pygame.display.set_mode((1, 1))
+
+
+def run_session(session: dict):
+    # one game from level start until player death or ticks end, rendering is skipped
+    start = perf_counter()
+    sim_clock = SimulationClock()
+    profiler = FrameProfiler(history=session["ticks"])
+    set_profiler(profiler)
+
+    store = EntityStore()
+    player, level_objs_map, entities, minimap = load_level(pygame.display.get_surface(), session["level"], store)
+    entity_index = SpatialHash([*entities, player])
+    collision_grid = CollisionGrid(level_objs_map)
+    flow_field = FlowField(level_objs_map)
+    projectiles = ProjectilePool()
+    enemies_amount = len(entities)
+    loaded = perf_counter()
+
+    script = BEHAVIOURS[session["behaviour"]](random.Random(session["seed"]))
+    death_tick = None
+    max_projectiles = 0
+    ticks = 0
+    for pressed_keys, pressed_mouse_buttons, mouse_pos in scripted_input(session["ticks"], script):
+        profiler.begin_frame()
+        process_look(mouse_pos, SIMULATION_DT, player)
+        entities, projectiles = simulation_step(pressed_keys, pressed_mouse_buttons, player, entities, projectiles,
+                                                level_objs_map, sim_clock.now(), SIMULATION_DT, entity_index,
+                                                collision_grid, store, flow_field)
+        sim_clock.advance(SIMULATION_DT * 1000)
+        profiler.end_frame()
+        ticks += 1
+        max_projectiles = max(max_projectiles, len(projectiles))
+        if is_player_dead(player):
+            death_tick = ticks
+            break
+    end = perf_counter()
+    set_profiler(None)
+
+    return {
+        **session,
+        "ticks_done": ticks,
+        "simulated_seconds": ticks * SIMULATION_DT,
+        "death_tick": death_tick,
+        "player_health": player.health,
+        "enemies": enemies_amount,
+        "enemies_killed": enemies_amount - len(entities),
+        "max_projectiles": max_projectiles,
+        "flow_field_updates": flow_field.updates,
+        "load_time": loaded - start,
+        "run_time": end - loaded,
+        "ticks_per_second": ticks / (end - loaded) if end > loaded else None,
+        "tick": summary(list(profiler.stats["frame"])) if ticks else None,
+        "stages": {stage: summary(list(profiler.stats[stage])) for stage in STAGES if stage in profiler.stats},
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Headless simulation of many sessions in a process pool, "
+                                                 "prints JSON results (seconds)")
+    parser.add_argument("--levels", nargs="*", default=["levels/level_3.txt"], help="level files")
+    parser.add_argument("--generated", nargs="*", default=[], help="sizes of generated levels, WIDTHxHEIGHT")
+    parser.add_argument("--enemies", type=int, default=20, help="enemies amount on generated levels")
+    parser.add_argument("--behaviours", nargs="*", default=list(BEHAVIOURS), choices=BEHAVIOURS)
+    parser.add_argument("--seeds", type=int, default=4, help="seeds per level for seeded behaviours and generated levels")
+    parser.add_argument("--ticks", type=int, default=60 * 120, help="session length limit in simulation ticks")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--outliers", type=int, default=5, help="sessions with the slowest p99 tick to report")
+    parser.add_argument("--output", help="file for results, stdout by default")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        levels = list(args.levels)
+        for size in args.generated:
+            width, height = (int(i) for i in size.split("x"))
+            for seed in range(args.seeds):
+                path = os.path.join(tmp_dir, f"generated_{size}_{seed}.txt")
+                with open(path, "w") as file:
+                    file.write("\n".join(generate_level(width, height, seed, args.enemies)))
+                levels.append(path)
+        # levels are compiled once here, not by every worker at the same time
+        for path in levels:
+            load_compiled_level(path)
+
+        sessions = [{"level": path, "behaviour": behaviour, "seed": seed, "ticks": args.ticks}
+                    for path in levels for behaviour in args.behaviours
+                    for seed in range(args.seeds if behaviour in SEEDED_BEHAVIOURS else 1)]
+        start = perf_counter()
+        # workers are started clean, forked SDL state is not safe to use
+        with multiprocessing.get_context("spawn").Pool(args.processes, initializer=init_worker) as pool:
+            results = list(pool.imap_unordered(run_session, sessions))
+        wall_time = perf_counter() - start
+
+        for result in results:
+            if result["level"].startswith(tmp_dir):
+                result["level"] = os.path.basename(result["level"])
+
+    results.sort(key=lambda r: (r["level"], r["behaviour"], r["seed"]))
+    timed = [r for r in results if r["tick"]]
+    output = json.dumps({
+        "processes": args.processes,
+        "sessions": len(results),
+        "wall_time": wall_time,
+        "sessions_per_hour": len(results) / wall_time * 3600,
+        "simulated_seconds": sum(r["simulated_seconds"] for r in results),
+        "deaths": sum(r["death_tick"] is not None for r in results),
+        "outliers": sorted(timed, key=lambda r: r["tick"]["p99"], reverse=True)[:args.outliers],
+        "results": results,
+    }, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    sys.exit(main())